@@ -1,77 +1,410 @@
-from flask import Flask, render_template, request, make_response, jsonify
-from scan import Scan, uids
+from flask import Flask, Response, abort, render_template, request, make_response, jsonify, send_file, \
+    stream_with_context
+from scan import Scan, compressed_volume_path, scan_validator
+from base import db
+from cache import LRUCache
+from volume_cache import VolumeCache
+from roi_store import RoiStore
+from prefetch import Prefetcher
+from warmup import Warmer
+import worklist_index
+import render
+import pyramid
+import slab
+import mpr
+import stats
+import roi_measure
+import metrics
+import conditional
+import common
+import storage
 import uuid
-import json
+import time
 import os
 
 
-def load_rois():
-    rois_by_scan = {}
-    dir = 'simple_imagine/rois'
-    for file in os.listdir(dir):
-        file_path = os.path.join(dir, file)
-
-        rois = []
-        with open(file_path) as infile:
-            for line in infile:
-                rois.append(json.loads(line))
-        rois_by_scan[file] = rois
-
-    return rois_by_scan
-
-
-def create_app():
+def create_app(config=None):
     app = Flask(__name__, instance_relative_config=True)
     app.config['DEBUG'] = True
     app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:////tmp/test.db'
-
-    # db.init_app(app)
-
-    rois_by_scan = load_rois()
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    # Minimal number of seconds between two syncs of the worklist index with the scans folder
+    app.config['WORKLIST_REFRESH_INTERVAL'] = 30
+    app.config['RENDER_CACHE_BYTES'] = 256 * 1024 * 1024
+    app.config['SLAB_CACHE_BYTES'] = 512 * 1024 * 1024
+    app.config['MPR_CACHE_BYTES'] = 256 * 1024 * 1024
+    # Volumes and slices are cached by clients and proxies, and revalidated once this many seconds passed
+    app.config['VOLUME_MAX_AGE'] = 0
+    # Decoded volumes shared by all workers as memory mapped files
+    app.config['VOLUME_CACHE_DIR'] = common.getTMpath('volume_cache', parent_dir='ssd')
+    app.config['VOLUME_CACHE_BYTES'] = 20 * 1024 ** 3
+    # Folder or storage URL of the .mat scans - None for the CTscans folder of the data root
+    app.config['SCAN_ROOT'] = None
+    # Folder of the compressed volumes - None to keep them next to their .mat
+    app.config['SCAN_VOLUME_ROOT'] = None
+    # Fast tier that scans are copied to once a worker viewed them SCAN_PROMOTE_AFTER times - None for none,
+    # such as common.getTMpath('CTscans', parent_dir='ssd')
+    app.config['SCAN_SSD_ROOT'] = None
+    app.config['SCAN_SSD_BYTES'] = 200 * 1024 ** 3
+    app.config['SCAN_PROMOTE_AFTER'] = 3
+    # Volumes are decoded in the background as soon as their scan page is opened
+    app.config['PREFETCH_WORKERS'] = 2
+    app.config['PREFETCH_MAX_PENDING'] = 16
+    # Number of scans of a worklist page to prefetch, starting from the top
+    app.config['PREFETCH_WORKLIST'] = 0
+    # ROI files of the previous file based storage, imported into the database on first access
+    app.config['ROI_LEGACY_DIR'] = 'simple_imagine/rois'
+    # ROI writes are committed together at most this many seconds after they were made
+    app.config['ROI_FLUSH_INTERVAL'] = 0.2
+    # uids listed in the worklist - None for all scans found in the scan root
+    app.config['WORKLIST_UIDS'] = None
+    # Phase timings in a Server-Timing header and Prometheus metrics at /metrics, per worker process
+    app.config['METRICS_ENABLED'] = True
+    # Under the ASGI adapter: threads running the app and reading responses, body chunks read at the same
+    # time and bytes read at a time, per worker process
+    app.config['ASGI_THREADS'] = 32
+    app.config['ASGI_MAX_READS'] = 16
+    app.config['ASGI_CHUNK_BYTES'] = 256 * 1024
+    # Warm the header index and volume caches of the most recent worklist scans in the background on start
+    app.config['WARMUP_ON_START'] = False
+    app.config['WARMUP_LIMIT'] = 50
+    app.config['WARMUP_WORKERS'] = 2
+    # Read budget over all warmup workers, and CPU budget of every warmup worker as a fraction of a CPU
+    app.config['WARMUP_READ_MB_PER_S'] = 200
+    app.config['WARMUP_CPU_FRACTION'] = 0.5
+    # Also write the compressed volumes of warmed scans that have none
+    app.config['WARMUP_COMPRESS'] = False
+    app.config.update(config or {})
+
+    storage.configure(app.config['SCAN_ROOT'], ssd=app.config['SCAN_SSD_ROOT'],
+                      volumes=app.config['SCAN_VOLUME_ROOT'], ssd_max_bytes=app.config['SCAN_SSD_BYTES'],
+                      promote_after=app.config['SCAN_PROMOTE_AFTER'])
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+    metrics.init_app(app)
+
+    rois_by_scan = RoiStore(app, legacy_dir=app.config['ROI_LEGACY_DIR'],
+                            flush_interval=app.config['ROI_FLUSH_INTERVAL'])
+    worklist_state = {'last_refresh': 0}
+    # Rendered slices by (scan validator, slice, window center, window width, format)
+    rendered_slices = LRUCache(app.config['RENDER_CACHE_BYTES'], sizeof=lambda item: len(item[0]))
+    # Slab reconstructions by (scan validator, mode, thickness, step)
+    slab_stacks = LRUCache(app.config['SLAB_CACHE_BYTES'], sizeof=lambda item: item[0].nbytes)
+    # Reformatted slices by (scan validator, plane, slice), and the geometries of the planes they cut
+    mpr_slices = LRUCache(app.config['MPR_CACHE_BYTES'], sizeof=lambda item: item[0].nbytes)
+    mpr_geometries = LRUCache(64, sizeof=lambda item: 1)
+    # Summarized HU statistics by scan validator
+    scan_stats = LRUCache(256, sizeof=lambda item: 1)
+    # ROI measurements by (scan validator, ROI fingerprint, group)
+    roi_measurements = LRUCache(1024, sizeof=lambda item: 1)
+    volumes = VolumeCache(app.config['VOLUME_CACHE_DIR'], app.config['VOLUME_CACHE_BYTES'])
+    prefetcher = Prefetcher(volumes, max_workers=app.config['PREFETCH_WORKERS'],
+                            max_pending=app.config['PREFETCH_MAX_PENDING'])
+    warmer = Warmer(volumes, max_workers=app.config['WARMUP_WORKERS'],
+                    read_mb_per_s=app.config['WARMUP_READ_MB_PER_S'],
+                    cpu_fraction=app.config['WARMUP_CPU_FRACTION'], compress=app.config['WARMUP_COMPRESS'])
+    if app.config['WARMUP_ON_START']:
+        warmer.start(app, scan_uids=app.config['WORKLIST_UIDS'], limit=app.config['WARMUP_LIMIT'])
 
     @app.route('/')
     def worklist():
-        scans = []
+        now = time.time()
+        if now - worklist_state['last_refresh'] >= app.config['WORKLIST_REFRESH_INTERVAL']:
+            with metrics.timer('index'):
+                worklist_index.update_index(scan_uids=app.config['WORKLIST_UIDS'])
+            worklist_state['last_refresh'] = now
 
-        for uid in uids:
-            try:
-                scan = Scan.fromID(uid, read_volume=False)
+        sort = request.args.get('sort', 'accessionNumber')
+        order = request.args.get('order', 'asc')
+        with metrics.timer('query'):
+            page = worklist_index.query_worklist(page=request.args.get('page', 1, type=int),
+                                                 per_page=request.args.get('per_page', 50, type=int),
+                                                 sort=sort, order=order)
+            scans = [header.to_dict() for header in page.items]
 
-                scans.append(
-                    {'accessionNumber': scan.metadata['AccessionNumber'], 'patientName': scan.name, 'uid': scan.uid})
+        for scan in scans[:app.config['PREFETCH_WORKLIST']]:
+            prefetcher.prefetch(scan['uid'])
 
-            except OSError:
-                continue
+        return render_template('index.html', scans=scans, page=page, sort=sort, order=order)
 
-        return render_template('index.html', scans=scans)
+    @app.route('/warmup')
+    def warmup_progress():
+        return jsonify(warmer.progress())
 
     @app.route('/view-scan/<uid>')
     def view_scan(uid):
         scan = Scan.fromID(uid, read_volume=False)
-        print(uid)
-        print(scan.metadata)
-        print(scan.size)
+        storage.default.record_access(uid)
+        # Decode the volume while the page and its scripts load
+        prefetcher.prefetch(uid)
         return render_template('view_scan.html', scan=scan)
 
+    def use_cached_volume(scan):
+        # A prefetch that is already decoding the volume is faster to wait for than to read around
+        with metrics.timer('prefetch'):
+            prefetcher.wait(scan.uid)
+        with metrics.timer('cache'):
+            volume = volumes.get(scan)
+        if volume is not None:
+            scan.volume = volume
+
+    def volume_validator(uid, variant=''):
+        with metrics.timer('validate'):
+            validator, last_modified = scan_validator(uid)
+        return validator + variant, last_modified
+
+    def slices_response(scan, start, stop, level, etag, last_modified):
+        """ Streams slices [start, stop) of the served volume, honoring a single byte range by reading
+            only the slices that cover it """
+        _, rows, columns = scan.stored_shape(level)
+        slice_nbytes = rows * columns * scan.dtype.itemsize
+        length = (stop - start) * slice_nbytes
+
+        byte_range = conditional.requested_range(request, etag, length)
+        if byte_range is False:
+            response = Response(status=416)
+            response.headers['Content-Range'] = 'bytes */%d' % length
+            return response
+        first, last = byte_range or (0, length)
+
+        def generate():
+            offset = first % slice_nbytes
+            remaining = last - first
+            for data in scan.iter_slices(start + first // slice_nbytes, start - (-last // slice_nbytes), level):
+                chunk = data[offset:offset + remaining]
+                offset = 0
+                remaining -= len(chunk)
+                yield chunk
+
+        response = Response(stream_with_context(generate()), status=206 if byte_range else 200)
+        response.headers['Content-Length'] = last - first
+        response.headers['Content-Type'] = 'application/octet-stream'
+        response.headers['Accept-Ranges'] = 'bytes'
+        if byte_range:
+            response.headers['Content-Range'] = 'bytes %d-%d/%d' % (first, last - 1, length)
+        response.headers['X-Rows'] = rows
+        response.headers['X-Columns'] = columns
+        return conditional.add_validators(response, etag, last_modified, app.config['VOLUME_MAX_AGE'])
+
     @app.route('/get-scan/<uid>')
     def get_scan(uid):
-        scan = Scan.fromID(uid, read_volume=True)
-        print(uid)
-        print(scan.metadata)
-
-        volume = scan.volume.tobytes()
+        # Fast path: hand the precompressed volume to the server as is and let the browser inflate it. Not
+        # when it holds a subset of the slices, as the identity response holds all of them
+        compressed_volume_file = compressed_volume_path(uid)
+        if 'gzip' in request.accept_encodings and os.path.isfile(compressed_volume_file) and \
+                not Scan.fromID(uid, read_volume=False).stores_slice_subset:
+            etag, last_modified = volume_validator(uid, '-gz')
+            response = send_file(compressed_volume_file, mimetype='application/octet-stream', etag=etag,
+                                 last_modified=int(last_modified), max_age=app.config['VOLUME_MAX_AGE'])
+            response.headers['Content-Encoding'] = 'gzip'
+            response.headers['Vary'] = 'Accept-Encoding'
+            response.cache_control.public = True
+            response.cache_control.must_revalidate = True
+            return response
+
+        etag, last_modified = volume_validator(uid)
+        if conditional.not_modified(request, etag, last_modified):
+            return conditional.not_modified_response(etag, last_modified, app.config['VOLUME_MAX_AGE'])
 
-        response = make_response(volume)
-        response.headers['Content-Length'] = len(volume)
-        response.headers['Content-Type'] = 'application/octet-stream'
+        scan = Scan.fromID(uid, read_volume=False)
+        with metrics.timer('cache'):
+            scan.volume = volumes.get_or_load(scan)
+        response = slices_response(scan, 0, scan.stored_shape()[0], 1, etag, last_modified)
+        response.headers['Vary'] = 'Accept-Encoding'
         return response
 
-    @app.route('/add-roi', methods=["POST"])
-    def add_roi():
-        content = request.get_json(force=True)
+    @app.route('/get-scan/<uid>/slices')
+    def get_scan_slices(uid):
+        # Pyramid level - 1 is full resolution, level n reduces rows and columns by n
+        level = request.args.get('level', 1, type=int)
+        if level != 1 and level not in pyramid.levels:
+            abort(400, 'Unsupported level: %d' % level)
 
-        scan_id = content['scan_id']
+        etag, last_modified = volume_validator(uid, '-' + common.string2hash(request.query_string.decode()))
+        if conditional.not_modified(request, etag, last_modified):
+            return conditional.not_modified_response(etag, last_modified, app.config['VOLUME_MAX_AGE'])
+
+        scan = Scan.fromID(uid, read_volume=False)
+        if level == 1:
+            use_cached_volume(scan)
+
+        num_slices = scan.stored_shape(level)[0]
+        start = request.args.get('start', 0, type=int)
+        stop = request.args.get('stop', num_slices, type=int)
+        start, stop, _ = slice(start, stop).indices(num_slices)
+        stop = max(start, stop)
+
+        response = slices_response(scan, start, stop, level, etag, last_modified)
+        response.headers['X-Slice-Range'] = '%d-%d' % (start, stop)
+        return response
 
+    @app.route('/get-scan/<uid>/slab')
+    def get_scan_slab(uid):
+        """ Average, MIP or MinIP slabs of thickness mm, starting every step mm. start and stop select a
+            range of the slabs """
+        mode = request.args.get('mode', 'mip')
+        if mode not in slab.modes:
+            abort(400, 'Unsupported mode: ' + mode)
+        thickness = request.args.get('thickness', 10.0, type=float)
+        step = request.args.get('step', None, type=float)
+        if thickness <= 0 or (step is not None and step <= 0):
+            abort(400, 'Slab thickness and step must be positive')
+
+        with metrics.timer('validate'):
+            validator, last_modified = scan_validator(uid)
+        etag = '%s-s%s' % (validator, common.string2hash(request.query_string.decode()))
+        if conditional.not_modified(request, etag, last_modified):
+            return conditional.not_modified_response(etag, last_modified, app.config['VOLUME_MAX_AGE'])
+
+        key = (validator, mode, thickness, step)
+        reconstructed = slab_stacks.get(key)
+        if reconstructed is None:
+            scan = Scan.fromID(uid, read_volume=False)
+            with metrics.timer('cache'):
+                volume = volumes.get_or_load(scan)
+            spacing = scan.slice_spacing(len(volume))
+            slices_per_slab, stride = slab.slab_geometry(spacing, thickness, step)
+            with metrics.timer('reconstruct'):
+                slabs = slab.reconstruct(volume, mode, slices_per_slab, stride)
+            slab_thickness = (slices_per_slab - 1) * spacing + (scan.metadata.get('SliceThickness') or spacing)
+            reconstructed = (slabs, slab_thickness, stride * spacing)
+            slab_stacks.put(key, reconstructed)
+
+        slabs, slab_thickness, slab_spacing = reconstructed
+        start = request.args.get('start', 0, type=int)
+        stop = request.args.get('stop', len(slabs), type=int)
+        start, stop, _ = slice(start, stop).indices(len(slabs))
+        stop = max(start, stop)
+
+        data = slabs[start:stop].tobytes()
+        response = make_response(data)
+        response.headers['Content-Length'] = len(data)
+        response.headers['Content-Type'] = 'application/octet-stream'
+        response.headers['X-Rows'] = slabs.shape[1]
+        response.headers['X-Columns'] = slabs.shape[2]
+        response.headers['X-Slab-Range'] = '%d-%d' % (start, stop)
+        response.headers['X-Slab-Count'] = len(slabs)
+        response.headers['X-Slab-Thickness'] = '%.3f' % slab_thickness
+        response.headers['X-Slab-Spacing'] = '%.3f' % slab_spacing
+        return conditional.add_validators(response, etag, last_modified, app.config['VOLUME_MAX_AGE'])
+
+    @app.route('/mpr/<uid>/<plane>/<int:slice>')
+    def get_mpr_slice(uid, plane, slice):
+        """ A single axial, coronal or sagittal slice of the volume, reformatted to square pixels. fmt selects
+            the raw values (default) or a windowed image, like /render """
+        if plane not in mpr.planes:
+            abort(400, 'Unsupported plane: ' + plane)
+        fmt = request.args.get('fmt', 'raw')
+        if fmt != 'raw' and fmt not in render.formats:
+            abort(400, 'Unsupported format: ' + fmt)
+
+        with metrics.timer('validate'):
+            validator, last_modified = scan_validator(uid)
+        etag = '%s-m%s%d-%s' % (validator, plane, slice, common.string2hash(request.query_string.decode()))
+        if conditional.not_modified(request, etag, last_modified):
+            return conditional.not_modified_response(etag, last_modified, app.config['VOLUME_MAX_AGE'])
+
+        key = (validator, plane, slice)
+        reformatted = mpr_slices.get(key)
+        if reformatted is None:
+            scan = Scan.fromID(uid, read_volume=False)
+            with metrics.timer('cache'):
+                volume = volumes.get_or_load(scan)
+            geometry = mpr_geometries.get((validator, plane))
+            if geometry is None:
+                geometry = mpr.scan_geometry(scan, volume.shape, plane)
+                mpr_geometries.put((validator, plane), geometry)
+            try:
+                with metrics.timer('reformat'):
+                    cut = geometry.cut(volume, slice)
+            except IndexError as e:
+                abort(404, str(e))
+            reformatted = (cut, geometry.num_slices, geometry.pixel_spacing, render.default_window(scan),
+                           scan.rescale())
+            mpr_slices.put(key, reformatted)
+
+        cut, num_slices, pixel_spacing, default_window, (slope, intercept) = reformatted
+        if fmt == 'raw':
+            data = cut.tobytes()
+            content_type = 'application/octet-stream'
+        else:
+            window_center = request.args.get('wc', default_window[0], type=float)
+            window_width = request.args.get('ww', default_window[1], type=float)
+            with metrics.timer('encode'):
+                data = render.encode(render.window_slice(cut, window_center, window_width, slope, intercept), fmt)
+            content_type = render.formats[fmt]
+
+        response = make_response(data)
+        response.headers['Content-Length'] = len(data)
+        response.headers['Content-Type'] = content_type
+        response.headers['X-Rows'] = cut.shape[0]
+        response.headers['X-Columns'] = cut.shape[1]
+        response.headers['X-Slice-Count'] = num_slices
+        response.headers['X-Pixel-Spacing'] = '%.4f\\%.4f' % pixel_spacing
+        return conditional.add_validators(response, etag, last_modified, app.config['VOLUME_MAX_AGE'])
+
+    @app.route('/stats/<uid>')
+    def get_stats(uid):
+        """ HU statistics of the volume and its slices, and suggested windows. They are computed in one pass
+            over the volume the first time they are asked for, and stored next to the compressed volume """
+        with metrics.timer('validate'):
+            validator, last_modified = scan_validator(uid)
+        etag = validator + '-stats'
+        if conditional.not_modified(request, etag, last_modified):
+            return conditional.not_modified_response(etag, last_modified, app.config['VOLUME_MAX_AGE'])
+
+        summary = scan_stats.get(validator)
+        if summary is None:
+            scan = Scan.fromID(uid, read_volume=False)
+            computed = stats.load(scan)
+            if computed is None:
+                with metrics.timer('cache'):
+                    volume = volumes.get_or_load(scan)
+                with metrics.timer('stats'):
+                    computed = stats.compute(volume, *scan.rescale())
+                stats.store(scan, computed)
+            summary = stats.summarize(computed, *scan.rescale(), default_window=render.default_window(scan))
+            scan_stats.put(validator, summary)
+
+        response = jsonify(summary)
+        return conditional.add_validators(response, etag, last_modified, app.config['VOLUME_MAX_AGE'])
+
+    @app.route('/render/<uid>/<int:slice>')
+    def render_slice(uid, slice):
+        window_center = request.args.get('wc', None, type=float)
+        window_width = request.args.get('ww', None, type=float)
+        fmt = request.args.get('fmt', 'png')
+        if fmt not in render.formats:
+            abort(400, 'Unsupported format: ' + fmt)
+
+        with metrics.timer('validate'):
+            validator, last_modified = scan_validator(uid)
+        etag = '%s-r%d-%s' % (validator, slice, common.string2hash(request.query_string.decode()))
+        if conditional.not_modified(request, etag, last_modified):
+            return conditional.not_modified_response(etag, last_modified, app.config['VOLUME_MAX_AGE'])
+
+        # The validator is part of the key so that renders of a changed scan are never served
+        key = (validator, slice, window_center, window_width, fmt)
+        rendered = rendered_slices.get(key)
+        if rendered is None:
+            scan = Scan.fromID(uid, read_volume=False)
+            use_cached_volume(scan)
+            try:
+                rendered = render.render_slice(scan, slice, window_center, window_width, fmt)
+            except IndexError as e:
+                abort(404, str(e))
+            rendered_slices.put(key, rendered)
+
+        data, (rows, columns) = rendered
+        response = make_response(data)
+        response.headers['Content-Length'] = len(data)
+        response.headers['Content-Type'] = render.formats[fmt]
+        response.headers['X-Rows'] = rows
+        response.headers['X-Columns'] = columns
+        return conditional.add_validators(response, etag, last_modified, app.config['VOLUME_MAX_AGE'])
+
+    def make_roi(content):
         x = content['x']
         y = content['y']
         w = content['w']
@@ -82,12 +415,51 @@ def create_app():
         roi = {'id': str(uuid.uuid1()), 'label': 'ROI ' + str(slice), 'slice': slice, 'color': color, 'x': x, 'y': y,
                'w': w,
                'h': h}
+        return roi
 
-        rois = get_rois_by_uid(scan_id)
+    def interpolate_rois(content):
+        """ Expands an ROI with a 'to' ROI into one ROI per slice between them, linearly interpolating
+            the rectangle. The 'to' ROI may hold only an image_index to copy the rectangle """
+        to = dict(content, **content['to'])
+        first, last = content['image_index'], to['image_index']
+        step = 1 if last >= first else -1
+        num_steps = abs(last - first)
 
-        rois.append(roi)
+        rois = []
+        for i, slice in enumerate(range(first, last + step, step)):
+            t = float(i) / num_steps if num_steps else 0.0
+            roi_content = dict(content, image_index=slice)
+            for key in ('x', 'y', 'w', 'h'):
+                roi_content[key] = content[key] + (to[key] - content[key]) * t
+            rois.append(make_roi(roi_content))
+        return rois
+
+    @app.route('/add-roi', methods=["POST"])
+    def add_roi():
+        content = request.get_json(force=True)
+
+        scan_id = content['scan_id']
+        roi = make_roi(content)
+
+        rois_by_scan.add(scan_id, roi)
         return jsonify(roi)
 
+    @app.route('/add-rois', methods=["POST"])
+    def add_rois():
+        content = request.get_json(force=True)
+
+        scan_id = content['scan_id']
+        rois = []
+        for roi_content in content['rois']:
+            if 'to' in roi_content:
+                rois.extend(interpolate_rois(roi_content))
+            else:
+                rois.append(make_roi(roi_content))
+
+        rois_by_scan.add_many(scan_id, rois)
+        # The groups are returned as well, to spare the client a /get-roi-groups request
+        return jsonify({'rois': rois, 'groups': get_rois_by_uid(scan_id).groups()})
+
     @app.route('/delete-roi', methods=["POST"])
     def delete_roi():
         content = request.get_json(force=True)
@@ -95,64 +467,73 @@ def create_app():
         scan_id = content['scan_id']
         group_id = content['id']
 
-        rois = get_rois_by_uid(scan_id)
-
-        for roi in rois[:]:
-            if roi['color'] == group_id:
-                rois.remove(roi)
+        rois_by_scan.delete_group(scan_id, group_id)
 
-        print("Deleted " + group_id + "," + str(rois))
-        return jsonify(rois)
+        return jsonify(get_rois_by_uid(scan_id).all())
 
     @app.route('/get-rois/<uid>/<slice>')
     def get_rois(uid, slice):
-
         rois = get_rois_by_uid(uid)
+        return jsonify(rois.in_slice(int(slice)))
 
-        rois_in_slice = []
-        for roi in rois:
-            if roi['slice'] == int(slice):
-                rois_in_slice.append(roi)
-        return jsonify(rois_in_slice)
+    @app.route('/get-rois/<uid>')
+    def get_rois_range(uid):
+        """ ROIs of slices [start, stop), grouped by slice. Slices without ROIs are omitted """
+        rois = get_rois_by_uid(uid)
+        start = request.args.get('start', 0, type=int)
+        stop = request.args.get('stop', None, type=int)
+        return jsonify({str(slice): slice_rois for slice, slice_rois in rois.in_slices(start, stop)})
 
     @app.route('/get-roi-groups/<uid>')
     def get_roi_groups(uid):
         rois = get_rois_by_uid(uid)
-
-        roi_groups = {}
-
-        for roi in rois:
-            color = roi['color']
-
-            if color not in roi_groups:
-                roi_groups[color] = {'label': 'ROI', 'min_slice': roi['slice'], 'max_slice': roi['slice'],
-                                     'color': color}
-            else:
-                roi_groups[color]['min_slice'] = min(roi['slice'], roi_groups[color]['min_slice'])
-                roi_groups[color]['max_slice'] = max(roi['slice'], roi_groups[color]['max_slice'])
-
-        return jsonify(list(roi_groups.values()))
+        return jsonify(rois.groups())
 
     @app.route('/save', methods=['POST'])
     def save():
-        content = request.get_json(force=True)
-
-        scan_id = content['scan_id']
-        rois = get_rois_by_uid(scan_id)
-
-        with open('simple_imagine/rois/' + scan_id, 'a') as outfile:
-            for roi in rois:
-                json.dump(roi, outfile)
-                outfile.write('\n')
+        # ROIs are stored as they are drawn - saving only makes sure the pending writes are committed
+        rois_by_scan.flush()
 
         return ""
 
-    def get_rois_by_uid(uid):
-
-        if uid not in rois_by_scan:
-            rois_by_scan[uid] = []
+    @app.route('/measure-rois/<uid>')
+    def measure_rois(uid):
+        """ Mean, std, min and max HU, area and volume of every ROI group of a scan and of all its ROIs
+            together, or of the group given by color only. The ROIs are measured over the pixels they cover
+            in the viewport given by scale, translation_x and translation_y, as cornerstone reports them,
+            and without a scale in the image fitted to the canvas. Cached until the ROIs or the scan change """
+        color = request.args.get('color', None)
+        scale = request.args.get('scale', None, type=float)
+        translation = (request.args.get('translation_x', 0.0, type=float),
+                       request.args.get('translation_y', 0.0, type=float))
+        if scale is not None and not scale > 0:
+            abort(400, 'Invalid scale: %s' % scale)
+        with metrics.timer('validate'):
+            validator, _ = scan_validator(uid)
+        with metrics.timer('query'):
+            rois = get_rois_by_uid(uid)
+            key = (validator, rois.fingerprint(color), color, scale, translation)
+        etag = '%s-rois-%s' % (validator, common.string2hash(repr((key[1], scale, translation))))
+        if conditional.not_modified(request, etag, None):
+            return conditional.not_modified_response(etag, None, 0)
+
+        measurements = roi_measurements.get(key)
+        if measurements is None:
+            scan = Scan.fromID(uid, read_volume=False)
+            with metrics.timer('cache'):
+                volume = volumes.get_or_load(scan)
+            with metrics.timer('measure'):
+                measurements = roi_measure.measure(
+                    volume, rois.in_group(color) if color is not None else rois.all(), *scan.rescale(),
+                    pixel_spacing=scan.metadata.get('PixelSpacing', (1.0, 1.0)),
+                    slice_spacing=scan.slice_spacing(len(volume)), scale=scale, translation=translation)
+            roi_measurements.put(key, measurements)
+
+        # ROIs change at any time, so clients always revalidate
+        return conditional.add_validators(jsonify(measurements), etag, None, 0)
 
-        return rois_by_scan[uid]
+    def get_rois_by_uid(uid):
+        return rois_by_scan.get(uid)
 
     return app
 
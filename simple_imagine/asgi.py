@@ -0,0 +1,155 @@
+""" ASGI serving mode of the app.
+
+    Under the sync gunicorn workers a worker is held by a download until its last byte reached the client,
+    so a few slow clients downloading volumes take all workers. Under this adapter the app runs in a
+    bounded thread pool, and responses are sent from the event loop: every chunk of a response body is read
+    in the pool - where the h5py reads happen - only once the previous chunk was sent. A slow client then
+    holds one pending send and at most one chunk, but neither a thread nor a worker. Serve it with an ASGI
+    server, for example:
+        gunicorn -w 4 -k uvicorn.workers.UvicornWorker 'asgi:create_asgi_app()'
+        uvicorn --factory asgi:create_asgi_app
+
+    Every request runs in its own copy of the context variables, so the request context of Flask and the
+    phase timers of metrics follow it from thread to thread """
+import io
+import sys
+import asyncio
+import contextvars
+import concurrent.futures
+from app import create_app
+
+
+class AsgiAdapter:
+    """ Serves a WSGI app over ASGI. threads bounds the threads running the app and reading bodies,
+        max_reads the body chunks being read at the same time, and chunk_size the bytes read at a time """
+
+    def __init__(self, wsgi_app, threads=32, max_reads=16, chunk_size=256 * 1024):
+        self.wsgi_app = wsgi_app
+        self.max_reads = max_reads
+        self.chunk_size = chunk_size
+        self.executor = concurrent.futures.ThreadPoolExecutor(threads, thread_name_prefix='asgi')
+        self._reads = None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self._http(scope, receive, send)
+        else:
+            raise ValueError('Unsupported ASGI scope type: %s' % scope['type'])
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _http(self, scope, receive, send):
+        loop = asyncio.get_running_loop()
+        if self._reads is None:
+            self._reads = asyncio.Semaphore(self.max_reads)
+
+        body = await _read_body(receive)
+        context = contextvars.copy_context()
+        started = []
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info is not None and started:
+                raise exc_info[1].with_traceback(exc_info[2])
+            started[:] = [status, headers]
+            return _no_write
+
+        def run(fn, *args):
+            return loop.run_in_executor(self.executor, context.run, fn, *args)
+
+        iterable = await run(self.wsgi_app, _environ(scope, body), start_response)
+        try:
+            chunks = iter(iterable)
+            async with self._reads:
+                chunk = await run(self._read, chunks)
+            status, headers = started
+            await send({'type': 'http.response.start', 'status': int(status.split(' ', 1)[0]),
+                        'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                                    for name, value in headers]})
+            while chunk:
+                # Sending waits while the transport of the client is full, which holds back the next read
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                async with self._reads:
+                    chunk = await run(self._read, chunks)
+            await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+        finally:
+            if hasattr(iterable, 'close'):
+                # Also runs the teardown of streamed responses, when the client went away before their end
+                await run(iterable.close)
+
+    def _read(self, chunks):
+        """ Returns the next chunk_size bytes or more of the body, and b'' at its end """
+        parts = []
+        size = 0
+        for part in chunks:
+            parts.append(part)
+            size += len(part)
+            if size >= self.chunk_size:
+                break
+        return b''.join(parts)
+
+
+def _no_write(data):
+    raise NotImplementedError('The write callable of start_response is not supported')
+
+
+async def _read_body(receive):
+    # Request bodies are ROIs and the like, small enough to read whole before calling the app
+    parts = []
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            break
+        parts.append(message.get('body', b''))
+        if not message.get('more_body', False):
+            break
+    return b''.join(parts)
+
+
+def _environ(scope, body):
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', ''),
+        # WSGI strings hold the raw bytes of the path as latin-1
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/%s' % scope.get('http_version', '1.1'),
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', ()):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_TYPE':
+            environ['CONTENT_TYPE'] = value
+        elif name != 'CONTENT_LENGTH':
+            key = 'HTTP_' + name
+            environ[key] = environ[key] + ',' + value if key in environ else value
+    return environ
+
+
+def create_asgi_app(config=None):
+    app = create_app(config)
+    return AsgiAdapter(app, threads=app.config['ASGI_THREADS'], max_reads=app.config['ASGI_MAX_READS'],
+                       chunk_size=app.config['ASGI_CHUNK_BYTES'])
@@ -0,0 +1,236 @@
+""" Benchmarks of the scan loading, compression and serving paths.
+
+    Usage: python -m benchmark [header|full|compress|codecs|routes|all] [uid ...] [--folder DIR] [--repeat N]
+                               [--codecs SPEC [SPEC ...]] [--output FILE]
+           python -m benchmark all --synthetic [--count N] [--slices N [N ...]] [--size N] [--output FILE]
+           python -m benchmark compare OLD.json NEW.json
+
+    Without uids, all known scans found in the folder are timed. With --synthetic the scans are generated
+    into a temporary folder instead, so the suite runs without any private data. The codecs benchmark
+    reports the ratio and the compression and decompression speed of each volume codec. Results are printed and,
+    with --output, saved as JSON so runs of different commits can be compared """
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+import numpy as np
+import common
+import storage
+import synthetic
+import volume_codecs
+import scan as scan_module
+from scan import Scan, uids as known_uids
+
+benchmarks = ('header', 'full', 'compress', 'codecs', 'routes')
+codec_specs = ('gzip:9', 'gzip:6', 'gzip:1', 'lzma:6', 'zlib:6', 'zlib+shuffle:6', 'zlib+delta:6',
+               'zlib+delta+shuffle:6', 'zlib+delta+shuffle:1')
+
+
+def time_call(fn, repeat=5):
+    """ Runs fn repeat times and returns its timings in milliseconds. The first run is reported on its
+        own, since it is the one that pays for cold caches """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - start) * 1000)
+    return {'first_ms': timings[0], 'min_ms': min(timings), 'median_ms': float(np.median(timings)),
+            'mean_ms': float(np.mean(timings))}
+
+
+def bench_header(scan_uids, scanfolder, repeat=5):
+    """ Times a full header parse, with the lazily read fields, and a lookup of the already parsed scan """
+    def parse():
+        scan_module.parsed_scans.clear()
+        scan = Scan.fromID(uid, scanfolder=scanfolder, read_volume=False)
+        return scan.metadata, scan.image_positions
+
+    results = []
+    for uid in scan_uids:
+        scan = Scan.fromID(uid, scanfolder=scanfolder, read_volume=False)
+        result = time_call(parse, repeat)
+        cached = time_call(lambda: Scan.fromID(uid, scanfolder=scanfolder, read_volume=False), repeat)
+        result.update({'uid': uid, 'slices': int(scan.size[0]), 'cached_ms': cached['median_ms']})
+        results.append(result)
+        print('header   %s: %d slices, %.2f ms (min %.2f ms), %.3f ms when parsed already' %
+              (uid, result['slices'], result['median_ms'], result['min_ms'], result['cached_ms']))
+    return results
+
+
+def bench_full(scan_uids, scanfolder, repeat=5):
+    results = []
+    for uid in scan_uids:
+        load = lambda: Scan.fromID(uid, scanfolder=scanfolder, read_volume=True, prefer_compressed_volume=False).volume
+        nbytes = load().nbytes
+        result = time_call(load, repeat)
+        result.update({'uid': uid, 'bytes': nbytes, 'mb_per_s': nbytes / 1e3 / result['median_ms']})
+        results.append(result)
+        print('full     %s: %.1f MB, %.2f ms, %.1f MB/s' %
+              (uid, nbytes / 1e6, result['median_ms'], result['mb_per_s']))
+    return results
+
+
+def bench_compress(scan_uids, scanfolder, repeat=3):
+    results = []
+    output_dir = tempfile.mkdtemp(prefix='benchmark-compress-')
+    try:
+        for uid in scan_uids:
+            scan = Scan.fromID(uid, scanfolder=scanfolder, read_volume=True, prefer_compressed_volume=False,
+                               compressed_volumes_dir=output_dir)
+            result = time_call(scan.store_compressed_volume, repeat)
+            compressed_nbytes = os.path.getsize(os.path.join(output_dir, common.string2hash(uid) + '.dat.gz'))
+            result.update({'uid': uid, 'bytes': scan.volume.nbytes, 'compressed_bytes': compressed_nbytes,
+                           'ratio': scan.volume.nbytes / float(compressed_nbytes),
+                           'mb_per_s': scan.volume.nbytes / 1e3 / result['median_ms']})
+            results.append(result)
+            print('compress %s: ratio %.2f, %.2f ms, %.1f MB/s' %
+                  (uid, result['ratio'], result['median_ms'], result['mb_per_s']))
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
+    return results
+
+
+def bench_routes(scan_uids, scanfolder, repeat=5):
+    from app import create_app
+
+    work_dir = tempfile.mkdtemp(prefix='benchmark-routes-')
+    try:
+        app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(work_dir, 'benchmark.db'),
+                          'VOLUME_CACHE_DIR': os.path.join(work_dir, 'volume_cache'),
+                          'ROI_LEGACY_DIR': None, 'WORKLIST_UIDS': scan_uids, 'WORKLIST_REFRESH_INTERVAL': 0,
+                          'PREFETCH_WORKERS': 1, 'DEBUG': False})
+        client = app.test_client()
+
+        results = []
+        for uid in scan_uids:
+            routes = ['/', '/view-scan/' + uid, '/get-scan/' + uid, '/get-scan/%s/slices?start=0&stop=1' % uid,
+                      '/render/%s/0?fmt=png' % uid, '/get-rois/%s/0' % uid, '/get-roi-groups/' + uid]
+            for route in routes:
+                def get():
+                    response = client.get(route)
+                    assert response.status_code == 200, '%s: %d' % (route, response.status_code)
+                    return len(response.get_data())
+
+                nbytes = get()
+                result = time_call(get, repeat)
+                result.update({'uid': uid, 'route': route, 'bytes': nbytes})
+                results.append(result)
+                print('route    %s: %.2f ms (first %.2f ms), %d bytes' %
+                      (route, result['median_ms'], result['first_ms'], nbytes))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return results
+
+
+def bench_codecs(scan_uids, scanfolder, repeat=3, specs=codec_specs):
+    """ Times encoding and decoding of whole volumes in memory, so disk speed does not blur the results """
+    results = []
+    for uid in scan_uids:
+        scan = Scan.fromID(uid, scanfolder=scanfolder, read_volume=True, prefer_compressed_volume=False)
+        volume = np.ascontiguousarray(scan.volume_to_store())
+        for spec in specs:
+            codec = volume_codecs.get_codec(spec)
+            encoded = codec.encode(volume)
+            if not np.array_equal(codec.decode(encoded, volume.dtype, volume.shape), volume):
+                raise AssertionError('%s: %s does not decode to the original volume' % (uid, spec))
+            encode = time_call(lambda: codec.encode(volume), repeat)
+            decode = time_call(lambda: codec.decode(encoded, volume.dtype, volume.shape), repeat)
+            result = {'uid': uid, 'codec': codec.spec, 'shape': list(volume.shape), 'bytes': volume.nbytes,
+                      'compressed_bytes': len(encoded), 'ratio': volume.nbytes / float(len(encoded)),
+                      'median_ms': encode['median_ms'], 'decode_median_ms': decode['median_ms'],
+                      'compress_mb_per_s': volume.nbytes / 1e3 / encode['median_ms'],
+                      'decompress_mb_per_s': volume.nbytes / 1e3 / decode['median_ms']}
+            results.append(result)
+            print('codec    %s %s: ratio %.2f, compress %.1f MB/s, decompress %.1f MB/s' %
+                  (uid, codec.spec, result['ratio'], result['compress_mb_per_s'], result['decompress_mb_per_s']))
+    return results
+
+
+def run(names, scan_uids, scanfolder, repeat, specs=codec_specs):
+    functions = {'header': bench_header, 'full': bench_full, 'compress': bench_compress, 'routes': bench_routes,
+                 'codecs': lambda *args: bench_codecs(*args, specs=specs)}
+    return {name: functions[name](scan_uids, scanfolder, repeat) for name in names}
+
+
+def compare(old_file, new_file):
+    """ Prints the median time ratio of every result found in both runs """
+    with open(old_file) as infile:
+        old = json.load(infile)
+    with open(new_file) as infile:
+        new = json.load(infile)
+
+    for name, new_results in new['results'].items():
+        # Routes and codecs are timed several times per scan
+        result_key = lambda r: (r['uid'], r.get('route') or r.get('codec'))
+        old_results = {result_key(r): r for r in old['results'].get(name, [])}
+        for result in new_results:
+            key = result_key(result)
+            if key not in old_results:
+                continue
+            old_ms, new_ms = old_results[key]['median_ms'], result['median_ms']
+            print('%-8s %s: %.2f ms -> %.2f ms (%.2fx)' %
+                  (name, key[1] or key[0], old_ms, new_ms, old_ms / max(new_ms, 1e-9)))
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark scan loading, compression and serving')
+    parser.add_argument('benchmark', choices=benchmarks + ('all', 'compare'))
+    parser.add_argument('uids', nargs='*', help='uids of the scans, or the two result files to compare')
+    parser.add_argument('--folder', default='', help='folder of the .mat scans (default: CTscans)')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output', help='JSON file to save the results to')
+    parser.add_argument('--codecs', nargs='+', default=codec_specs, help='codec specs of the codecs benchmark')
+    parser.add_argument('--synthetic', action='store_true', help='benchmark generated scans')
+    parser.add_argument('--count', type=int, default=1, help='synthetic scans per slice count')
+    parser.add_argument('--slices', type=int, nargs='+', default=[40, 150], help='slice counts of synthetic scans')
+    parser.add_argument('--size', type=int, default=512, help='rows and columns of synthetic scans')
+    args = parser.parse_args(argv)
+
+    if args.benchmark == 'compare':
+        compare(*args.uids)
+        return
+
+    synthetic_dir = None
+    try:
+        if args.synthetic:
+            synthetic_dir = tempfile.mkdtemp(prefix='benchmark-synthetic-')
+            scanfolder = os.path.join(synthetic_dir, 'CTscans')
+            os.makedirs(scanfolder)
+            # The routes look for scans in the CTscans folder of the data root
+            common.res_strings[common.getMachineName() + 'DATA'] = synthetic_dir
+            scan_uids = []
+            for slices in args.slices:
+                scan_uids += synthetic.write_scans(scanfolder, args.count, prefix='synthetic-%d' % slices,
+                                                   slices=slices, rows=args.size, columns=args.size)
+        else:
+            scanfolder = args.folder or storage.default.archive.root
+            scan_uids = args.uids or storage.default.scan_uids(scanfolder, known_uids)
+
+        names = benchmarks if args.benchmark == 'all' else (args.benchmark,)
+        results = {'benchmarks': list(names), 'time': time.time(), 'revision': git_revision(),
+                   'python': sys.version.split()[0], 'synthetic': args.synthetic,
+                   'results': run(names, scan_uids, scanfolder, args.repeat, args.codecs)}
+    finally:
+        if synthetic_dir is not None:
+            shutil.rmtree(synthetic_dir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w') as outfile:
+            json.dump(results, outfile, indent=2)
+    return results
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+import threading
+import collections
+
+
+class LRUCache:
+    """ Thread safe LRU cache bounded by the total size of its values, as measured by sizeof """
+
+    def __init__(self, max_size, sizeof=len):
+        self.max_size = max_size
+        self.sizeof = sizeof
+        self.size = 0
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._items:
+                return default
+            self._items.move_to_end(key)
+            return self._items[key][0]
+
+    def put(self, key, value):
+        size = self.sizeof(value)
+        with self._lock:
+            if key in self._items:
+                self.size -= self._items.pop(key)[1]
+            if size > self.max_size:
+                return
+            self._items[key] = (value, size)
+            self.size += size
+            while self.size > self.max_size:
+                _, (_, evicted_size) = self._items.popitem(last=False)
+                self.size -= evicted_size
+
+    def pop(self, key, default=None):
+        with self._lock:
+            if key not in self._items:
+                return default
+            value, size = self._items.pop(key)
+            self.size -= size
+            return value
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.size = 0
+
+    def keys(self):
+        with self._lock:
+            return list(self._items.keys())
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._items
+
+    def __len__(self):
+        with self._lock:
+            return len(self._items)
@@ -0,0 +1,149 @@
+""" Bulk compression of scan volumes into <hash>.dat.gz files, <hash>.dat.vol packed volumes or <hash>.vol
+    chunked volumes.
+
+    Usage: python -m compress [uid ...] [--uid-file FILE] [--folder DIR] [--output-dir DIR] [--workers N]
+                              [--format gzip|packed|chunked] [--codec SPEC] [--pyramid] [--stats]
+
+    Without uids, every known scan found in the folder is compressed. Scans whose compressed volume is
+    newer than their .mat are skipped, so an interrupted run can simply be started again. Chunked volumes
+    are converted from an up to date .dat.gz when there is one, instead of reading the HDF5 volume. A scan
+    keeps both its .dat.gz and its packed volume while they are newer than its .mat.
+    Packed and chunked volumes are compressed with --codec, a volume_codecs spec such as 'lzma:6' or
+    'zlib+delta+shuffle:6'. With --pyramid the reduced resolution levels of the volume are stored as well,
+    and with --stats its HU statistics """
+import os
+import glob
+import time
+import logging
+import argparse
+import multiprocessing
+import common
+import storage
+import stats
+from scan import Scan, compressed_volume_path, packed_volume_path, chunked_volume_path, uids as known_uids
+
+logger = logging.getLogger(__name__)
+
+
+volume_paths = {'gzip': compressed_volume_path, 'packed': packed_volume_path, 'chunked': chunked_volume_path}
+default_codecs = {'gzip': 'gzip', 'packed': 'zlib+shuffle', 'chunked': 'zlib'}
+
+
+def is_up_to_date(volume_file, mat_file):
+    if not os.path.isfile(volume_file) or not os.path.isfile(mat_file):
+        return False
+    return os.path.getmtime(volume_file) > os.path.getmtime(mat_file)
+
+
+def needs_compression(uid, scanfolder, output_dir, format='gzip'):
+    mat_file = os.path.join(scanfolder, common.string2hash(uid) + '.mat')
+    return not is_up_to_date(volume_paths[format](uid, output_dir), mat_file)
+
+
+def compress_scan(args):
+    uid, scanfolder, output_dir, format, codec, compresslevel, with_pyramid, with_stats = args
+    volume_file = volume_paths[format](uid, output_dir)
+    mat_file = os.path.join(scanfolder, common.string2hash(uid) + '.mat')
+    start = time.time()
+    try:
+        # Leftovers of a killed run
+        for tmp_file in glob.glob(volume_file + '.*.tmp'):
+            os.remove(tmp_file)
+
+        if format == 'chunked' and is_up_to_date(compressed_volume_path(uid, output_dir), mat_file):
+            scan = Scan.fromID(uid, scanfolder=scanfolder, read_volume=False, compressed_volumes_dir=output_dir)
+            nbytes = scan.convert_compressed_volume(compresslevel=compresslevel, codec=codec)
+        else:
+            scan = Scan.fromID(uid, scanfolder=scanfolder, read_volume=True, prefer_compressed_volume=False,
+                               compressed_volumes_dir=output_dir)
+            if format == 'chunked':
+                nbytes = scan.store_chunked_volume(compresslevel=compresslevel, codec=codec)
+            else:
+                nbytes = scan.store_compressed_volume(compresslevel=compresslevel, codec=codec)
+
+        if with_pyramid:
+            scan.store_pyramid()
+        if with_stats:
+            stats.scan_stats(scan, scan.volume if len(scan.volume) else None)
+    except Exception as e:
+        return uid, 0, 0, time.time() - start, str(e)
+
+    return uid, nbytes, os.path.getsize(volume_file), time.time() - start, None
+
+
+def compress_all(scan_uids, scanfolder, output_dir, workers=None, format='gzip', compresslevel=9,
+                 with_pyramid=False, codec=None, with_stats=False):
+    codec = codec or default_codecs[format]
+    pending = [uid for uid in scan_uids if needs_compression(uid, scanfolder, output_dir, format)]
+    print('%d scans to compress, %d already up to date' % (len(pending), len(scan_uids) - len(pending)))
+
+    start = time.time()
+    total_bytes = 0
+    done = 0
+    failed = 0
+    pool = multiprocessing.Pool(workers or os.cpu_count())
+    try:
+        jobs = [(uid, scanfolder, output_dir, format, codec, compresslevel, with_pyramid, with_stats)
+                for uid in pending]
+        for uid, nbytes, compressed_nbytes, seconds, error in pool.imap_unordered(compress_scan, jobs):
+            if error is not None:
+                failed += 1
+                print('%s: failed - %s' % (uid, error))
+                continue
+
+            done += 1
+            total_bytes += nbytes
+            elapsed = time.time() - start
+            print('[%d/%d] %s: %.1f MB -> %.1f MB in %.1fs | %.1f MB/s, %.1f scans/min' %
+                  (done + failed, len(pending), uid, nbytes / 1e6, compressed_nbytes / 1e6, seconds,
+                   total_bytes / 1e6 / elapsed, done * 60 / elapsed))
+    finally:
+        pool.terminate()
+        pool.join()
+
+    elapsed = time.time() - start
+    print('Compressed %d scans (%d failed), %.1f MB in %.1fs | %.1f MB/s, %.1f scans/min' %
+          (done, failed, total_bytes / 1e6, elapsed, total_bytes / 1e6 / max(elapsed, 1e-9),
+           done * 60 / max(elapsed, 1e-9)))
+    return done, failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compress scan volumes into .dat.gz files')
+    parser.add_argument('uids', nargs='*', help='uids of the scans to compress')
+    parser.add_argument('--uid-file', help='file with one uid per line')
+    parser.add_argument('--folder', default='', help='folder of the .mat scans (default: CTscans)')
+    parser.add_argument('--output-dir', help='folder of the compressed volumes (default: the scans folder)')
+    parser.add_argument('--workers', type=int, help='number of worker processes (default: all cores)')
+    parser.add_argument('--format', choices=sorted(volume_paths), default='gzip')
+    parser.add_argument('--codec', help='codec of packed and chunked volumes (default: %s for packed, %s for '
+                                        'chunked)' % (default_codecs['packed'], default_codecs['chunked']))
+    parser.add_argument('--compresslevel', type=int, help='unless given by the codec (default: 9 for gzip, 6 '
+                                                          'otherwise)')
+    parser.add_argument('--pyramid', action='store_true', help='also store the reduced resolution levels')
+    parser.add_argument('--stats', action='store_true', help='also store the HU statistics')
+    args = parser.parse_args()
+
+    scanfolder = args.folder or storage.default.archive.root
+    output_dir = args.output_dir or scanfolder
+
+    scan_uids = list(args.uids)
+    if args.uid_file:
+        with open(args.uid_file) as infile:
+            scan_uids.extend(line.strip() for line in infile if line.strip())
+    if not scan_uids:
+        scan_uids = storage.default.scan_uids(scanfolder, known_uids)
+
+    compresslevel = args.compresslevel
+    if compresslevel is None:
+        compresslevel = 9 if args.format == 'gzip' else 6
+
+    if args.codec and args.format == 'gzip':
+        parser.error('--codec applies to packed and chunked volumes only')
+
+    compress_all(scan_uids, scanfolder, output_dir, workers=args.workers, format=args.format,
+                 compresslevel=compresslevel, with_pyramid=args.pyramid, codec=args.codec, with_stats=args.stats)
+
+
+if __name__ == '__main__':
+    main()
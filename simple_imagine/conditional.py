@@ -0,0 +1,46 @@
+""" Validators, conditional GETs and byte ranges for volume and slice responses """
+import datetime
+from flask import Response
+
+
+def not_modified(request, etag, last_modified):
+    """ True when the client already holds this representation. Only the request headers are looked at,
+        so it is safe to call before any scan file is opened """
+    if request.if_none_match:
+        return request.if_none_match.contains(etag)
+    if request.if_modified_since and last_modified is not None:
+        if_modified_since = request.if_modified_since
+        if if_modified_since.tzinfo is None:
+            if_modified_since = if_modified_since.replace(tzinfo=datetime.timezone.utc)
+        return int(last_modified) <= if_modified_since.timestamp()
+    return False
+
+
+def not_modified_response(etag, last_modified, max_age=0):
+    return add_validators(Response(status=304), etag, last_modified, max_age)
+
+
+def add_validators(response, etag, last_modified, max_age=0):
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = int(last_modified)
+    response.cache_control.public = True
+    response.cache_control.max_age = max_age
+    response.cache_control.must_revalidate = True
+    return response
+
+
+def requested_range(request, etag, length):
+    """ Returns the single (start, stop) byte range requested for a representation of the given length,
+        None to send it whole, or False when the range cannot be satisfied """
+    if request.range is None:
+        return None
+    if 'If-Range' in request.headers and request.headers['If-Range'].strip() != '"%s"' % etag:
+        return None
+    if request.range.units != 'bytes' or len(request.range.ranges) != 1:
+        # Multipart ranges are not supported - send the whole representation instead
+        return None
+    byte_range = request.range.range_for_length(length)
+    if byte_range is None:
+        return False
+    return byte_range
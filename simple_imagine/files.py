@@ -0,0 +1,36 @@
+""" Writing files in place of others, so that readers never see a partially written file.
+
+    A file is written to a temporary file next to it, in the same folder so that it is on the same file
+    system, and renamed over it once complete. Readers see either the previous file or the new one """
+import os
+import tempfile
+import contextlib
+
+
+def temp_path(path):
+    """ Creates an empty temporary file next to path, named after it, and returns its path """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix=os.path.basename(path) + '.',
+                                    suffix='.tmp')
+    os.close(fd)
+    return tmp_path
+
+
+@contextlib.contextmanager
+def replacing(path):
+    """ Yields the path of a temporary file to write, which replaces path once the block ends without an
+        error, and is removed otherwise """
+    tmp_path = temp_path(path)
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    except BaseException:
+        remove(tmp_path)
+        raise
+
+
+def remove(path):
+    """ Removes a file if it can, such as one that may already be gone """
+    try:
+        os.remove(path)
+    except OSError:
+        pass
@@ -0,0 +1,92 @@
+""" Pool of open read-only HDF5 files.
+
+    Opening a .mat file costs more than parsing its header, so files stay open between requests. A pooled
+    handle is reopened when the mtime or size of its file changes, and the least recently used handles are
+    closed once more than max_handles are open. Handles in use are only closed after their last user
+    releases them """
+import os
+import threading
+import contextlib
+import collections
+import h5py
+import metrics
+
+max_handles = 32
+
+
+class _Handle:
+    __slots__ = ('file', 'stamp', 'users', 'retired')
+
+    def __init__(self, file, stamp):
+        self.file = file
+        self.stamp = stamp
+        self.users = 0
+        self.retired = False
+
+
+class HandlePool:
+
+    def __init__(self, max_handles=max_handles):
+        self.max_handles = max_handles
+        self._handles = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    @contextlib.contextmanager
+    def open(self, path):
+        handle = self._acquire(path)
+        try:
+            yield handle.file
+        finally:
+            self._release(handle)
+
+    def _acquire(self, path):
+        stat = os.stat(path)
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            if self._pid != os.getpid():
+                # Handles inherited from the parent of a forked worker are not ours to use or close
+                self._handles.clear()
+                self._pid = os.getpid()
+
+            handle = self._handles.get(path)
+            if handle is not None and handle.stamp == stamp:
+                self._handles.move_to_end(path)
+                handle.users += 1
+                return handle
+            if handle is not None:
+                self._retire(path)
+
+            with metrics.timer('open'):
+                # Without locking, so that handles kept open never block the writers of the files
+                handle = _Handle(h5py.File(path, 'r', locking=False), stamp)
+            handle.users += 1
+            self._handles[path] = handle
+            while len(self._handles) > self.max_handles:
+                self._retire(next(iter(self._handles)))
+            return handle
+
+    def _retire(self, path):
+        handle = self._handles.pop(path)
+        handle.retired = True
+        if handle.users == 0:
+            handle.file.close()
+
+    def _release(self, handle):
+        with self._lock:
+            handle.users -= 1
+            if handle.retired and handle.users == 0:
+                handle.file.close()
+
+    def close(self):
+        with self._lock:
+            for path in list(self._handles):
+                self._retire(path)
+
+
+pool = HandlePool()
+
+
+def open_file(path):
+    """ Context manager of the pooled h5py.File of path """
+    return pool.open(path)
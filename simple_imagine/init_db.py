@@ -1,6 +1,6 @@
-from simple_imagine.base import db
+from base import db
 
-from  simple_imagine.app import create_app
+from app import create_app
 
 
 def init_db():
@@ -0,0 +1,246 @@
+""" Load test of volume downloads by many slow clients, comparing the sync and the ASGI serving modes.
+
+    Usage: python -m loadtest modes [--synthetic] [--workers N] [--clients N] [--rate KB/S] [--duration S]
+                                    [--slices N] [--size N] [--output FILE]
+           python -m loadtest run URL UID [--clients N] [--rate KB/S] [--duration S] [--output FILE]
+           python -m loadtest serve {sync,async} [--port N] [--workers N] [--data DIR] [uid ...]
+
+    run downloads the slices of a scan from a running server with --clients connections, each reading at
+    --rate KB/s, for --duration seconds. Meanwhile a probe asks for the ROI groups of the scan every
+    probe_interval seconds - when all workers are held by downloads, its latency grows with the length of
+    the downloads. modes serves the same scans in both modes under gunicorn, with the same number of
+    workers, runs the same load against each, and prints them side by side. The async mode needs uvicorn
+    for its gunicorn worker class """
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import asyncio
+import argparse
+import tempfile
+import subprocess
+import urllib.parse
+import numpy as np
+import common
+import synthetic
+
+modes = ('sync', 'async')
+worker_classes = {'sync': 'sync', 'async': 'uvicorn.workers.UvicornWorker'}
+probe_interval = 0.2
+# Seconds after which a request without response headers counts as failed
+request_timeout = 30.0
+read_size = 64 * 1024
+
+
+async def request(host, port, path, rate=None, deadline=None):
+    """ GETs path, reading the body at most at rate bytes per second, until its end or the deadline.
+        Returns (status, time to the response headers, body bytes read) """
+    start = time.perf_counter()
+    reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), request_timeout)
+    try:
+        writer.write(('GET %s HTTP/1.1\r\nHost: %s:%d\r\nAccept-Encoding: identity\r\nConnection: close\r\n\r\n' %
+                      (path, host, port)).encode('latin-1'))
+        await writer.drain()
+        head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), request_timeout)
+        first_byte = time.perf_counter() - start
+        status = int(head.split(b' ', 2)[1])
+
+        nbytes = 0
+        while deadline is None or time.perf_counter() < deadline:
+            data = await reader.read(read_size)
+            if not data:
+                break
+            nbytes += len(data)
+            if rate:
+                # Sleep until this client would have read nbytes at its rate
+                delay = start + first_byte + nbytes / float(rate) - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+        return status, first_byte, nbytes
+    finally:
+        writer.close()
+
+
+async def _download_loop(host, port, path, rate, deadline, results):
+    while time.perf_counter() < deadline:
+        try:
+            status, first_byte, nbytes = await request(host, port, path, rate, deadline)
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+            results['errors'] += 1
+            await asyncio.sleep(probe_interval)
+            continue
+        results['bytes'] += nbytes
+        results['first_byte'].append(first_byte)
+        if status != 200:
+            results['errors'] += 1
+        elif time.perf_counter() < deadline:
+            results['downloads'] += 1
+
+
+async def _probe_loop(host, port, path, deadline, results):
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        try:
+            status, _, _ = await request(host, port, path)
+            results['probe'].append(time.perf_counter() - start)
+            if status != 200:
+                results['probe_errors'] += 1
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+            results['probe_errors'] += 1
+        await asyncio.sleep(probe_interval)
+
+
+def _percentiles_ms(values):
+    if not values:
+        return {'p50_ms': None, 'p99_ms': None, 'max_ms': None}
+    values = np.asarray(values) * 1000
+    return {'p50_ms': float(np.percentile(values, 50)), 'p99_ms': float(np.percentile(values, 99)),
+            'max_ms': float(values.max())}
+
+
+def run_load(url, uid, clients=200, rate=256 * 1024, duration=20.0):
+    """ Runs the load against a running server and returns its results """
+    parsed = urllib.parse.urlsplit(url)
+    host, port = parsed.hostname, parsed.port or 80
+    prefix = parsed.path.rstrip('/')
+    results = {'bytes': 0, 'downloads': 0, 'errors': 0, 'first_byte': [], 'probe': [], 'probe_errors': 0}
+
+    async def main():
+        deadline = time.perf_counter() + duration
+        tasks = [_download_loop(host, port, '%s/get-scan/%s/slices' % (prefix, uid), rate, deadline, results)
+                 for _ in range(clients)]
+        tasks.append(_probe_loop(host, port, '%s/get-roi-groups/%s' % (prefix, uid), deadline, results))
+        await asyncio.gather(*tasks)
+
+    start = time.perf_counter()
+    asyncio.run(main())
+    elapsed = time.perf_counter() - start
+    return {'url': url, 'uid': uid, 'clients': clients, 'rate': rate, 'duration_s': elapsed,
+            'mb_per_s': results['bytes'] / 1e6 / elapsed, 'downloads': results['downloads'],
+            'errors': results['errors'], 'first_byte': _percentiles_ms(results['first_byte']),
+            'probe': _percentiles_ms(results['probe']), 'probes': len(results['probe']),
+            'probe_errors': results['probe_errors']}
+
+
+def print_results(mode, result):
+    print('%-6s %7.1f MB/s, %5d downloads, %4d errors, first byte p50 %s ms, probe p50 %s ms p99 %s ms, '
+          '%d probe errors' % (mode, result['mb_per_s'], result['downloads'], result['errors'],
+                               _format_ms(result['first_byte']['p50_ms']), _format_ms(result['probe']['p50_ms']),
+                               _format_ms(result['probe']['p99_ms']), result['probe_errors']))
+
+
+def _format_ms(value):
+    return '-' if value is None else '%.1f' % value
+
+
+def serve(mode, port, workers, data_dir=None, scan_uids=None):
+    """ Serves the app in a mode under gunicorn until interrupted """
+    from gunicorn.app.base import BaseApplication
+
+    if data_dir is not None:
+        # The routes look for scans in the CTscans folder of the data root
+        common.res_strings[common.getMachineName() + 'DATA'] = data_dir
+    work_dir = data_dir or tempfile.mkdtemp(prefix='loadtest-')
+    config = {'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(work_dir, 'loadtest.db'),
+              'VOLUME_CACHE_DIR': os.path.join(work_dir, 'volume_cache'), 'ROI_LEGACY_DIR': None,
+              'WORKLIST_UIDS': scan_uids or None, 'DEBUG': False}
+
+    class Server(BaseApplication):
+
+        def load_config(self):
+            self.cfg.set('bind', '127.0.0.1:%d' % port)
+            self.cfg.set('workers', workers)
+            self.cfg.set('worker_class', worker_classes[mode])
+            self.cfg.set('backlog', 4096)
+            self.cfg.set('timeout', 0)
+
+        def load(self):
+            # Loaded in every worker after the fork, so no database connection or HDF5 handle is shared
+            if mode == 'async':
+                from asgi import create_asgi_app
+                return create_asgi_app(config)
+            from app import create_app
+            return create_app(config)
+
+    Server().run()
+
+
+def _wait_for_port(port, process, timeout=60.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('Server exited with status %d' % process.returncode)
+        try:
+            socket.create_connection(('127.0.0.1', port), 1.0).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError('Server did not listen on port %d' % port)
+
+
+def compare_modes(data_dir, uid, workers, clients, rate, duration, port=8765):
+    results = {}
+    for mode in modes:
+        process = subprocess.Popen([sys.executable, '-m', 'loadtest', 'serve', mode, '--port', str(port),
+                                    '--workers', str(workers), '--data', data_dir, uid],
+                                   cwd=os.path.dirname(os.path.abspath(__file__)))
+        try:
+            _wait_for_port(port, process)
+            # One download first, so both modes start with the volume decoded in the cache
+            asyncio.run(request('127.0.0.1', port, '/get-scan/%s/slices' % uid))
+            results[mode] = dict(run_load('http://127.0.0.1:%d' % port, uid, clients, rate, duration),
+                                 workers=workers)
+        finally:
+            process.terminate()
+            process.wait()
+        print_results(mode, results[mode])
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Load test volume downloads by slow clients')
+    parser.add_argument('command', choices=('modes', 'run', 'serve'))
+    parser.add_argument('args', nargs='*', help='URL and uid to run against, or the mode and uids to serve')
+    parser.add_argument('--clients', type=int, default=200, help='concurrent downloads')
+    parser.add_argument('--rate', type=float, default=256, help='download speed of every client in KB/s')
+    parser.add_argument('--duration', type=float, default=20, help='seconds of load')
+    parser.add_argument('--workers', type=int, default=4, help='server worker processes')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--data', help='data root holding the CTscans folder')
+    parser.add_argument('--slices', type=int, default=150, help='slices of the synthetic scan')
+    parser.add_argument('--size', type=int, default=512, help='rows and columns of the synthetic scan')
+    parser.add_argument('--output', help='JSON file to save the results to')
+    args = parser.parse_args(argv)
+    rate = args.rate * 1024
+
+    if args.command == 'serve':
+        serve(args.args[0], args.port, args.workers, args.data, args.args[1:])
+        return
+    if args.command == 'run':
+        url, uid = args.args
+        results = run_load(url, uid, args.clients, rate, args.duration)
+        print_results('run', results)
+    else:
+        data_dir = args.data or tempfile.mkdtemp(prefix='loadtest-synthetic-')
+        try:
+            if args.data is None:
+                os.makedirs(os.path.join(data_dir, 'CTscans'))
+                uid = synthetic.write_scans(os.path.join(data_dir, 'CTscans'), 1, prefix='loadtest',
+                                            slices=args.slices, rows=args.size, columns=args.size)[0]
+            else:
+                uid = args.args[0]
+            results = compare_modes(data_dir, uid, args.workers, args.clients, rate, args.duration, args.port)
+        finally:
+            if args.data is None:
+                shutil.rmtree(data_dir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w') as outfile:
+            json.dump(results, outfile, indent=2)
+    return results
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,192 @@
+""" Phase timers, Server-Timing headers and Prometheus metrics.
+
+    Code times its phases with 'with metrics.timer(name):'. Inside a request the phases are reported in the
+    Server-Timing header of the response and aggregated into histograms, served in the Prometheus text
+    format. Outside a request, or when metrics are disabled, timer returns a shared no-op context """
+import time
+import bisect
+import threading
+import contextvars
+from flask import request, Response
+
+# (phases, start) of the current request. A context variable rather than a thread local, so a request
+# that is served by several threads in turn, as under the ASGI adapter, keeps its own phases
+_state = contextvars.ContextVar('metrics_state', default=None)
+
+duration_buckets = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class _NullTimer:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_null_timer = _NullTimer()
+
+
+class _Timer:
+    __slots__ = ('name', 'phases', 'start')
+
+    def __init__(self, name, phases):
+        self.name = name
+        self.phases = phases
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.phases.append((self.name, time.perf_counter() - self.start))
+        return False
+
+
+def timer(name):
+    state = _state.get()
+    if state is None:
+        return _null_timer
+    return _Timer(name, state[0])
+
+
+class Histogram:
+
+    def __init__(self, name, help, label_names, buckets=duration_buckets):
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels, value):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][bisect.bisect_left(self.buckets, value)] += 1
+            series[1] += value
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s histogram' % self.name]
+        with self._lock:
+            for labels, (counts, total) in sorted(self._series.items()):
+                label_text = _labels(self.label_names, labels)
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float('inf'),), counts):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append('%s_bucket{%s} %d' % (self.name, _join(label_text, 'le="%s"' % le), cumulative))
+                lines.append('%s_sum{%s} %r' % (self.name, label_text, total))
+                lines.append('%s_count{%s} %d' % (self.name, label_text, cumulative))
+        return lines
+
+
+class Counter:
+
+    def __init__(self, name, help, label_names):
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels, value=1):
+        with self._lock:
+            self._series[labels] = self._series.get(labels, 0) + value
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s counter' % self.name]
+        with self._lock:
+            for labels, value in sorted(self._series.items()):
+                lines.append('%s{%s} %r' % (self.name, _labels(self.label_names, labels), value))
+        return lines
+
+
+def _labels(names, values):
+    return ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                    for name, value in zip(names, values))
+
+
+def _join(*parts):
+    return ','.join(part for part in parts if part)
+
+
+request_duration = Histogram('simple_imagine_request_duration_seconds',
+                             'Time to produce a response, excluding streamed bodies', ('route', 'method'))
+phase_duration = Histogram('simple_imagine_phase_duration_seconds', 'Time spent in each phase of a request',
+                           ('route', 'phase'))
+stream_duration = Histogram('simple_imagine_stream_duration_seconds', 'Time to write streamed response bodies',
+                            ('route',))
+requests_total = Counter('simple_imagine_requests_total', 'Requests by route and status', ('route', 'status'))
+response_bytes = Counter('simple_imagine_response_bytes_total', 'Bytes of response bodies', ('route',))
+
+registry = [request_duration, phase_duration, stream_duration, requests_total, response_bytes]
+
+
+def render_metrics():
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+def _count_stream(iterable, route):
+    start = time.perf_counter()
+    nbytes = 0
+    try:
+        for chunk in iterable:
+            nbytes += len(chunk)
+            yield chunk
+    finally:
+        if hasattr(iterable, 'close'):
+            iterable.close()
+        response_bytes.inc((route,), nbytes)
+        stream_duration.observe((route,), time.perf_counter() - start)
+
+
+def init_app(app):
+    if not app.config.get('METRICS_ENABLED', True):
+        return
+
+    @app.before_request
+    def start_request_timer():
+        _state.set(([], time.perf_counter()))
+
+    @app.after_request
+    def report_request_timing(response):
+        state = _state.get()
+        if state is None:
+            return response
+        phases, start = state
+        total = time.perf_counter() - start
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+
+        durations = {}
+        for name, seconds in phases:
+            durations[name] = durations.get(name, 0.0) + seconds
+        for name, seconds in durations.items():
+            phase_duration.observe((route, name), seconds)
+        request_duration.observe((route, request.method), total)
+        requests_total.inc((route, response.status_code))
+
+        timings = ['%s;dur=%.3f' % (name, seconds * 1000) for name, seconds in durations.items()]
+        timings.append('total;dur=%.3f' % (total * 1000))
+        response.headers['Server-Timing'] = ', '.join(timings)
+
+        if response.direct_passthrough or not response.is_streamed:
+            # Files are passed to the server as they are, and wrapping them would lose sendfile
+            response_bytes.inc((route,), response.content_length or 0)
+        else:
+            response.response = _count_stream(response.response, route)
+        return response
+
+    @app.teardown_request
+    def stop_request_timer(exc):
+        _state.set(None)
+
+    @app.route('/metrics')
+    def metrics():
+        return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,101 @@
+""" Multiplanar reformats of a volume.
+
+    A reformatted slice cuts the (slices, rows, columns) volume at a fixed index of one of its axes. When
+    the slice axis lies in the reformatted image, it is resampled to the pixel spacing of the other image
+    axis, using the image position of every slice, so reformatted images have square pixels. Images are
+    oriented as they are read: patient right on the left of axial and coronal images, anterior on the left
+    of sagittal images, and superior (anterior for axial images) at the top """
+import numpy as np
+
+# (normal, right, down) of each plane, in the LPS patient coordinates of DICOM
+planes = {
+    'axial': ((0, 0, 1), (1, 0, 0), (0, 1, 0)),
+    'coronal': ((0, 1, 0), (1, 0, 0), (0, 0, -1)),
+    'sagittal': ((1, 0, 0), (0, 1, 0), (0, 0, -1)),
+}
+
+
+class Geometry:
+    """ How a plane cuts a volume: the volume axis held at a fixed index, the volume axes along the image
+        rows and columns and whether they are flipped, and the resampling of the slice axis.
+
+        axis_directions are the unit vectors along which the slice, row and column indices grow, spacings
+        the distances in mm between consecutive slices, rows and columns, and slice_coordinates the
+        increasing position in mm of every slice along the first direction """
+
+    def __init__(self, shape, axis_directions, spacings, slice_coordinates, plane):
+        normal, right, down = (np.array(v, dtype=np.float64) for v in planes[plane])
+        self.axis = int(np.argmax([abs(np.dot(d, normal)) for d in axis_directions]))
+        remaining = [a for a in range(3) if a != self.axis]
+        down_alignment = [abs(np.dot(axis_directions[a], down)) for a in remaining]
+        self.row_axis = remaining[int(np.argmax(down_alignment))]
+        self.column_axis = remaining[1 - int(np.argmax(down_alignment))]
+        self.transpose = self.row_axis > self.column_axis
+        self.flip_rows = np.dot(axis_directions[self.row_axis], down) < 0
+        self.flip_columns = np.dot(axis_directions[self.column_axis], right) < 0
+        self.num_slices = int(shape[self.axis])
+
+        lengths = [int(s) for s in shape]
+        spacings = [float(s) for s in spacings]
+        # (lower slice, weight of the upper slice) of every sample along the slice axis
+        self.samples = None
+        if self.axis != 0 and len(slice_coordinates) > 1:
+            other_axis = remaining[1 - remaining.index(0)]
+            step = spacings[other_axis]
+            count = int(np.floor((slice_coordinates[-1] - slice_coordinates[0]) / step + 1e-6)) + 1
+            targets = slice_coordinates[0] + np.arange(count) * step
+            lower = np.clip(np.searchsorted(slice_coordinates, targets, side='right') - 1,
+                            0, len(slice_coordinates) - 2)
+            gaps = np.maximum(slice_coordinates[lower + 1] - slice_coordinates[lower], 1e-6)
+            weights = np.clip((targets - slice_coordinates[lower]) / gaps, 0, 1).astype(np.float32)
+            self.samples = (lower, weights)
+            lengths[0] = count
+            spacings[0] = step
+
+        self.shape = (lengths[self.row_axis], lengths[self.column_axis])
+        self.pixel_spacing = (spacings[self.row_axis], spacings[self.column_axis])
+
+    def cut(self, volume, index):
+        """ Returns reformatted slice index of volume, reading only the voxels of that cut """
+        if not 0 <= index < self.num_slices:
+            raise IndexError('Slice %d out of range' % index)
+        cut = np.take(volume, index, axis=self.axis)
+        if self.samples is not None:
+            # The slice axis is the first axis of the cut - blend neighbouring slices linearly
+            lower, weights = self.samples
+            weights = weights[:, np.newaxis]
+            blended = cut[lower] * (1 - weights) + cut[lower + 1] * weights
+            if np.issubdtype(cut.dtype, np.integer):
+                blended = np.rint(blended)
+            cut = blended.astype(volume.dtype)
+
+        if self.transpose:
+            cut = cut.T
+        if self.flip_rows:
+            cut = cut[::-1]
+        if self.flip_columns:
+            cut = cut[:, ::-1]
+        return np.ascontiguousarray(cut)
+
+
+def scan_geometry(scan, shape, plane):
+    """ Geometry of a plane of the stored volume of a scan, of the given shape """
+    orientation = np.asarray(scan.image_orientation, dtype=np.float64).ravel()
+    row_direction, column_direction = orientation[:3], orientation[3:6]
+    num_slices = int(shape[0])
+    spacing = scan.slice_spacing(num_slices)
+
+    positions = np.asarray(scan.image_positions, dtype=np.float64)
+    normal = positions[-1] - positions[0] if len(positions) == num_slices and num_slices > 1 else np.zeros(3)
+    if np.linalg.norm(normal) > 0:
+        normal /= np.linalg.norm(normal)
+        slice_coordinates = (positions - positions[0]).dot(normal)
+    else:
+        # Slices are assumed to be stacked along the normal of the image plane
+        normal = np.cross(row_direction, column_direction)
+        slice_coordinates = np.arange(num_slices) * spacing
+
+    pixel_spacing = np.asarray(scan.metadata.get('PixelSpacing', (1.0, 1.0)), dtype=np.float64).ravel()
+    # Rows are pixel_spacing[0] apart along the column direction, columns pixel_spacing[1] along the row direction
+    return Geometry(shape, (normal, column_direction, row_direction), (spacing, pixel_spacing[0], pixel_spacing[1]),
+                    slice_coordinates, plane)
@@ -0,0 +1,58 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from scan import Scan
+
+logger = logging.getLogger(__name__)
+
+
+class Prefetcher:
+    """ Decodes volumes into the volume cache in the background, on a bounded thread pool. A prefetch of a
+        scan that is already queued or running is coalesced with it, and requests beyond max_pending
+        are dropped """
+
+    def __init__(self, volumes, max_workers=2, max_pending=16):
+        self.volumes = volumes
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='prefetch')
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def prefetch(self, uid):
+        """ Schedules the decoding of a scan volume. Returns its future, or None if the queue is full """
+        with self._lock:
+            if uid in self._in_flight:
+                return self._in_flight[uid]
+            if len(self._in_flight) >= self.max_pending:
+                return None
+            future = self._executor.submit(self._load, uid)
+            self._in_flight[uid] = future
+
+        future.add_done_callback(lambda _: self._done(uid))
+        return future
+
+    def wait(self, uid, timeout=None):
+        """ Waits for an in flight prefetch of a scan, if there is one. Returns the decoded volume or None """
+        with self._lock:
+            future = self._in_flight.get(uid)
+        if future is None:
+            return None
+        try:
+            return future.result(timeout)
+        except Exception:
+            return None
+
+    def _load(self, uid):
+        try:
+            scan = Scan.fromID(uid, read_volume=False)
+            return self.volumes.get_or_load(scan)
+        except Exception:
+            logger.exception('uid %s: Error prefetching volume', uid)
+            raise
+
+    def _done(self, uid):
+        with self._lock:
+            self._in_flight.pop(uid, None)
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
@@ -0,0 +1,59 @@
+""" Multi-resolution pyramid of a volume. Every level keeps all the slices and reduces the in-plane
+    resolution by an integer factor using block means, so level 4 holds 1/16 of the full volume """
+import numpy as np
+import volume_format
+
+levels = (2, 4)
+
+
+def level_shape(shape, level):
+    return (shape[0],) + tuple(-(-int(s) // level) for s in shape[1:])
+
+
+def downsample(slices, level):
+    """ Block-mean reduction of a (slices, rows, columns) stack. Edges that do not fill a whole
+        block are padded by repeating the last row/column """
+    num_slices, rows, columns = slices.shape
+    pad_rows = -rows % level
+    pad_columns = -columns % level
+    if pad_rows or pad_columns:
+        slices = np.pad(slices, ((0, 0), (0, pad_rows), (0, pad_columns)), mode='edge')
+
+    blocks = slices.reshape(num_slices, (rows + pad_rows) // level, level, (columns + pad_columns) // level, level)
+    reduced = blocks.mean(axis=(2, 4), dtype=np.float32)
+    if np.issubdtype(slices.dtype, np.integer):
+        reduced = np.rint(reduced)
+    return reduced.astype(slices.dtype)
+
+
+def build(slice_iter, shape, dtype, paths, rescale=(1.0, 0.0), plane='axial', slab=8, compresslevel=6,
+          source=None):
+    """ Writes a chunked volume per level from an iterator of full resolution slices. paths maps each
+        level to its file, and source, the validator of the full resolution volume, is recorded in every
+        level. Slices are reduced slab by slab, so memory stays at about one slab """
+    writers = {}
+    try:
+        for level, path in paths.items():
+            writers[level] = volume_format.VolumeWriter(path, level_shape(shape, level), dtype, rescale=rescale,
+                                                        plane=plane, compresslevel=compresslevel, source=source)
+
+        pending = []
+        for slice_data in slice_iter:
+            pending.append(slice_data)
+            if len(pending) == slab:
+                _write_slab(writers, np.stack(pending))
+                pending = []
+        if pending:
+            _write_slab(writers, np.stack(pending))
+    except BaseException:
+        for writer in writers.values():
+            writer.abort()
+        raise
+
+    for writer in writers.values():
+        writer.close()
+
+
+def _write_slab(writers, slices):
+    for level, writer in writers.items():
+        writer.write_slices(downsample(slices, level))
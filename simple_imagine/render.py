@@ -0,0 +1,85 @@
+""" Server side rendering of windowed 8-bit slices """
+import io
+import functools
+import numpy as np
+from PIL import Image
+import metrics
+
+formats = {'png': 'image/png', 'jpeg': 'image/jpeg', 'raw8': 'application/octet-stream'}
+
+
+def default_window(scan):
+    """ Returns the (center, width) window of a scan. defWindow is in HU and is used when the stored
+        values can be rescaled to HU, otherwise normWindow matches the stored values """
+    if 'RescaleSlope' in scan.metadata or 'RescaleIntercept' in scan.metadata:
+        window = scan.defWindow
+    else:
+        window = scan.normWindow
+    window = np.asarray(window, dtype=np.float64).flatten()
+    return float(window[0]), float(window[1])
+
+
+@functools.lru_cache(maxsize=64)
+def window_lut(window_center, window_width, slope, intercept, dtype_str):
+    """ Lookup table that maps every stored value of a 16-bit dtype, indexed through its uint16 view,
+        to a windowed uint8 value """
+    stored_values = np.arange(2 ** 16, dtype=np.uint16).view(np.dtype(dtype_str))
+    return _apply_window(stored_values, window_center, window_width, slope, intercept)
+
+
+def _apply_window(values, window_center, window_width, slope, intercept):
+    hu = values * np.float32(slope) + np.float32(intercept)
+    low = window_center - window_width / 2.0
+    scaled = (hu - np.float32(low)) * np.float32(255.0 / max(window_width, 1e-6))
+    return np.clip(scaled, 0, 255).astype(np.uint8)
+
+
+def window_slice(slice_data, window_center, window_width, slope=1.0, intercept=0.0):
+    if slice_data.dtype.itemsize == 2 and slice_data.dtype.kind in 'iu':
+        lut = window_lut(window_center, window_width, slope, intercept, slice_data.dtype.str)
+        return lut[slice_data.view(np.uint16)]
+    return _apply_window(slice_data, window_center, window_width, slope, intercept)
+
+
+def encode_png(image, compresslevel=6):
+    """ Encodes a 2D uint8 array as an 8-bit grayscale PNG """
+    output = io.BytesIO()
+    Image.fromarray(image, mode='L').save(output, format='PNG', compress_level=compresslevel)
+    return output.getvalue()
+
+
+def encode_jpeg(image, quality=90):
+    output = io.BytesIO()
+    Image.fromarray(image, mode='L').save(output, format='JPEG', quality=quality)
+    return output.getvalue()
+
+
+def encode(image, fmt):
+    if fmt == 'png':
+        return encode_png(image)
+    elif fmt == 'jpeg':
+        return encode_jpeg(image)
+    elif fmt == 'raw8':
+        return np.ascontiguousarray(image).tobytes()
+    else:
+        raise ValueError('Unsupported format: ' + fmt)
+
+
+def render_slice(scan, slice_idx, window_center=None, window_width=None, fmt='png'):
+    default_center, default_width = default_window(scan)
+    if window_center is None:
+        window_center = default_center
+    if window_width is None:
+        window_width = default_width
+
+    with metrics.timer('read'):
+        slice_data = scan.read_slices(slice_idx, slice_idx + 1)
+    if len(slice_data) == 0:
+        raise IndexError('Slice %d out of range' % slice_idx)
+
+    with metrics.timer('window'):
+        image = window_slice(slice_data[0], window_center, window_width,
+                             scan.metadata.get('RescaleSlope', 1.0), scan.metadata.get('RescaleIntercept', 0.0))
+    with metrics.timer('encode'):
+        data = encode(image, fmt)
+    return data, image.shape
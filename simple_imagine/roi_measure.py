@@ -0,0 +1,115 @@
+""" HU measurements of the ROIs of a scan.
+
+    ROIs are rectangles drawn on the viewer canvas, in canvas coordinates, and the viewer draws them there
+    whatever the zoom and pan of its viewport. They are mapped to image pixels through the viewport - by
+    default the image fitted to the canvas and centered - and a pixel belongs to a rectangle when its
+    center does. The
+    rectangles of every slice are rasterized into one mask per ROI group, plus one of all ROIs, and every
+    mask of a slice is reduced against the HU values of that slice in a single matrix product, so a slice
+    is read once however many ROIs it holds. Overlapping rectangles of a group count their pixels once """
+import numpy as np
+
+# Size in pixels of the square viewer canvas that ROI coordinates are given in
+canvas_size = 512
+
+
+def pixel_rectangles(rois, rows, columns, canvas_size=canvas_size, scale=None, translation=(0.0, 0.0)):
+    """ Returns the (row start, row stop, column start, column stop) image pixels covered by every ROI, as
+        an (ROIs, 4) array clipped to the image. scale and translation are those of the cornerstone viewport,
+        which scales the image around the canvas center and translates it by translation image pixels. A
+        scale of None fits the image to the canvas """
+    rect = np.array([[roi['x'], roi['y'], roi['w'], roi['h']] for roi in rois], dtype=np.float64).reshape(-1, 4)
+    # Rectangles drawn up or left have a negative size
+    x0 = np.minimum(rect[:, 0], rect[:, 0] + rect[:, 2])
+    x1 = np.maximum(rect[:, 0], rect[:, 0] + rect[:, 2])
+    y0 = np.minimum(rect[:, 1], rect[:, 1] + rect[:, 3])
+    y1 = np.maximum(rect[:, 1], rect[:, 1] + rect[:, 3])
+
+    if scale is None:
+        scale = min(float(canvas_size) / columns, float(canvas_size) / rows)
+    # Canvas position of the corner of the first image pixel
+    offset_x = canvas_size / 2.0 + (translation[0] - columns / 2.0) * scale
+    offset_y = canvas_size / 2.0 + (translation[1] - rows / 2.0) * scale
+
+    def pixels(start, stop, offset, length):
+        start = np.ceil((start - offset) / scale - 0.5)
+        stop = np.ceil((stop - offset) / scale - 0.5)
+        return np.clip(start, 0, length).astype(np.int64), np.clip(stop, 0, length).astype(np.int64)
+
+    row_start, row_stop = pixels(y0, y1, offset_y, rows)
+    column_start, column_stop = pixels(x0, x1, offset_x, columns)
+    return np.stack([row_start, row_stop, column_start, column_stop], axis=1)
+
+
+def _summary(voxels, total, total_squares, minimum, maximum, pixel_area, slice_spacing):
+    if not voxels:
+        return {'voxels': 0, 'area_mm2': 0.0, 'volume_mm3': 0.0, 'mean': None, 'std': None, 'min': None,
+                'max': None}
+    mean = total / voxels
+    return {'voxels': int(voxels), 'area_mm2': float(voxels * pixel_area),
+            'volume_mm3': float(voxels * pixel_area * slice_spacing), 'mean': float(mean),
+            'std': float(np.sqrt(max(total_squares / voxels - mean * mean, 0.0))),
+            'min': float(minimum), 'max': float(maximum)}
+
+
+def measure(volume, rois, slope=1.0, intercept=0.0, pixel_spacing=(1.0, 1.0), slice_spacing=1.0,
+            canvas_size=canvas_size, scale=None, translation=(0.0, 0.0)):
+    """ Returns the HU measurements of every ROI group (color) and of all ROIs together, over a
+        (slices, rows, columns) volume of stored values. ROIs on slices outside the volume are left out.
+        volume may be a memory map - only the slices that hold ROIs are read. scale and translation are
+        those of the viewport the ROIs are shown in, see pixel_rectangles """
+    num_slices, rows, columns = volume.shape
+    rois = [roi for roi in rois if 0 <= roi['slice'] < num_slices]
+    colors = sorted(set(roi['color'] for roi in rois))
+    group_index = {color: i for i, color in enumerate(colors)}
+    # The last mask of every slice is the union of all ROIs
+    num_masks = len(colors) + 1
+
+    voxels = np.zeros(num_masks, dtype=np.int64)
+    totals = np.zeros(num_masks)
+    total_squares = np.zeros(num_masks)
+    minima = np.full(num_masks, np.inf)
+    maxima = np.full(num_masks, -np.inf)
+    extents = {}
+
+    if rois:
+        rectangles = pixel_rectangles(rois, rows, columns, canvas_size, scale, translation)
+        slices = np.array([roi['slice'] for roi in rois], dtype=np.int64)
+        groups = np.array([group_index[roi['color']] for roi in rois], dtype=np.int64)
+        for color in colors:
+            group_slices = slices[groups == group_index[color]]
+            extents[color] = (int(group_slices.min()), int(group_slices.max()), len(group_slices))
+
+        row_range = np.arange(rows)
+        column_range = np.arange(columns)
+        order = np.argsort(slices, kind='stable')
+        boundaries = np.flatnonzero(np.diff(slices[order])) + 1
+        for members in np.split(order, boundaries):
+            slice_rects = rectangles[members]
+            in_rows = (row_range >= slice_rects[:, 0:1]) & (row_range < slice_rects[:, 1:2])
+            in_columns = (column_range >= slice_rects[:, 2:3]) & (column_range < slice_rects[:, 3:4])
+            rect_masks = in_rows[:, :, np.newaxis] & in_columns[:, np.newaxis, :]
+
+            masks = np.zeros((num_masks, rows, columns), dtype=bool)
+            np.logical_or.at(masks, groups[members], rect_masks)
+            masks[-1] = rect_masks.any(axis=0)
+            masks = masks.reshape(num_masks, -1)
+
+            hu = np.asarray(volume[slices[members[0]]], dtype=np.float64).ravel() * slope + intercept
+            weights = masks.astype(np.float64)
+            voxels += masks.sum(axis=1)
+            totals += weights.dot(hu)
+            total_squares += weights.dot(hu * hu)
+            minima = np.minimum(minima, np.where(masks, hu, np.inf).min(axis=1))
+            maxima = np.maximum(maxima, np.where(masks, hu, -np.inf).max(axis=1))
+
+    pixel_spacing = np.asarray(pixel_spacing, dtype=np.float64).ravel()
+    pixel_area = float(pixel_spacing[0] * pixel_spacing[1])
+    results = [_summary(voxels[i], totals[i], total_squares[i], minima[i], maxima[i], pixel_area, slice_spacing)
+               for i in range(num_masks)]
+    for color, result in zip(colors, results):
+        result['color'] = color
+        result['min_slice'], result['max_slice'], result['rois'] = extents[color]
+    results[-1]['rois'] = len(rois)
+    return {'pixel_spacing': [float(s) for s in pixel_spacing[:2]], 'slice_spacing': float(slice_spacing),
+            'groups': results[:-1], 'all': results[-1]}
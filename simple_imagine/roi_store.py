@@ -0,0 +1,294 @@
+import os
+import json
+import hashlib
+import time
+import atexit
+import itertools
+import logging
+import threading
+import collections
+from sqlalchemy.exc import IntegrityError
+from base import db
+
+logger = logging.getLogger(__name__)
+
+
+class ScanRois:
+    """ ROIs of a single scan, indexed by slice and by group (color). The slice extents of every group
+        are maintained as ROIs are added, so lookups cost O(result) """
+
+    def __init__(self, rois=()):
+        self._rois = {}
+        self._by_slice = {}
+        self._by_group = {}
+        self._extents = {}
+        for roi in rois:
+            self.add(roi)
+
+    def add(self, roi):
+        if roi['id'] in self._rois:
+            self.remove(roi['id'])
+
+        slice, color = roi['slice'], roi['color']
+        self._rois[roi['id']] = roi
+        self._by_slice.setdefault(slice, {})[roi['id']] = roi
+        self._by_group.setdefault(color, {})[roi['id']] = roi
+
+        if color in self._extents:
+            extent = self._extents[color]
+            extent[0] = min(extent[0], slice)
+            extent[1] = max(extent[1], slice)
+        else:
+            self._extents[color] = [slice, slice]
+
+    def remove(self, roi_id):
+        roi = self._rois.pop(roi_id)
+        slice, color = roi['slice'], roi['color']
+
+        del self._by_slice[slice][roi_id]
+        if not self._by_slice[slice]:
+            del self._by_slice[slice]
+
+        group = self._by_group[color]
+        del group[roi_id]
+        if not group:
+            del self._by_group[color]
+            del self._extents[color]
+        elif slice in self._extents[color]:
+            # Only an ROI on the edge of its group can shrink the group extent
+            slices = [group_roi['slice'] for group_roi in group.values()]
+            self._extents[color] = [min(slices), max(slices)]
+        return roi
+
+    def delete_group(self, color):
+        removed = list(self._by_group.pop(color, {}).values())
+        self._extents.pop(color, None)
+        for roi in removed:
+            del self._rois[roi['id']]
+            del self._by_slice[roi['slice']][roi['id']]
+            if not self._by_slice[roi['slice']]:
+                del self._by_slice[roi['slice']]
+        return removed
+
+    def in_slice(self, slice):
+        return list(self._by_slice.get(slice, {}).values())
+
+    def in_slices(self, start=0, stop=None):
+        """ Returns (slice, ROIs) of all slices in [start, stop) that have ROIs, ordered by slice """
+        if stop is not None and stop - start < len(self._by_slice):
+            slices = [slice for slice in range(start, stop) if slice in self._by_slice]
+        else:
+            slices = sorted(slice for slice in self._by_slice if slice >= start and (stop is None or slice < stop))
+        return [(slice, list(self._by_slice[slice].values())) for slice in slices]
+
+    def add_many(self, rois):
+        for roi in rois:
+            self.add(roi)
+
+    def in_group(self, color):
+        return list(self._by_group.get(color, {}).values())
+
+    def groups(self):
+        return [{'label': 'ROI', 'min_slice': min_slice, 'max_slice': max_slice, 'color': color}
+                for color, (min_slice, max_slice) in self._extents.items()]
+
+    def all(self):
+        return list(self._rois.values())
+
+    def fingerprint(self, color=None):
+        """ Digest of the ROIs, or of the ROIs of one group, that changes whenever they change """
+        rois = self.in_group(color) if color is not None else self.all()
+        digest = hashlib.sha1()
+        for roi in sorted(rois, key=lambda roi: roi['id']):
+            digest.update(repr(tuple(roi.get(key) for key in roi_fields)).encode('utf-8'))
+        return digest.hexdigest()[:16]
+
+    def __len__(self):
+        return len(self._rois)
+
+    def __iter__(self):
+        return iter(self.all())
+
+
+class Roi(db.Model):
+    __tablename__ = 'roi'
+
+    id = db.Column(db.String(36), primary_key=True)
+    scan_uid = db.Column(db.String(128), nullable=False, index=True)
+    slice = db.Column(db.Integer, nullable=False)
+    color = db.Column(db.String(16), nullable=False)
+    label = db.Column(db.String(64))
+    x = db.Column(db.Float)
+    y = db.Column(db.Float)
+    w = db.Column(db.Float)
+    h = db.Column(db.Float)
+
+    @classmethod
+    def from_dict(cls, uid, roi):
+        return cls(scan_uid=uid, **{key: roi.get(key) for key in roi_fields})
+
+    def to_dict(self):
+        return {key: getattr(self, key) for key in roi_fields}
+
+
+roi_fields = ('id', 'label', 'slice', 'color', 'x', 'y', 'w', 'h')
+
+
+class RoiScan(db.Model):
+    """ Version of the ROIs of a scan, bumped by every write so workers know when to reload them """
+    __tablename__ = 'roi_scan'
+
+    uid = db.Column(db.String(128), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+
+class RoiStore:
+    """ ROIs of all scans, shared by all workers through the database.
+
+        The ROIs of a scan are loaded on first use and reloaded only when another worker changed them.
+        Writes are applied to the local index at once and committed to the database in groups by a
+        background thread, every flush_interval seconds. Scans that have no ROIs in the database yet are
+        imported from the legacy one-file-per-scan directory """
+
+    def __init__(self, app, legacy_dir=None, flush_interval=0.2):
+        self.app = app
+        self.legacy_dir = legacy_dir
+        self.flush_interval = flush_interval
+        self._scans = {}
+        self._pending = []
+        # Writes taken by flushes that have not committed them yet, one list per flush
+        self._flushing = []
+        self._lock = threading.RLock()
+        self._flush_needed = threading.Condition(self._lock)
+        self._flusher = None
+        self._flusher_pid = None
+        atexit.register(self.flush)
+
+    def get(self, uid):
+        version = self._db_version(uid)
+        with self._lock:
+            entry = self._scans.get(uid)
+            if entry is not None and entry[0] == version:
+                return entry[1]
+
+        if version is None:
+            self._import_legacy(uid)
+            version = self._db_version(uid)
+
+        rois = ScanRois(roi.to_dict() for roi in Roi.query.filter_by(scan_uid=uid))
+        with self._lock:
+            # Writes of this worker that are not committed yet, including those being committed, which the
+            # database may or may not show yet - replaying them is harmless either way
+            for op, op_uid, arg in itertools.chain(*(self._flushing + [self._pending])):
+                if op_uid == uid:
+                    getattr(rois, op)(arg)
+            self._scans[uid] = [version, rois]
+        return rois
+
+    def add(self, uid, roi):
+        self._write('add', uid, roi)
+
+    def add_many(self, uid, rois):
+        self._write('add_many', uid, rois)
+
+    def delete_group(self, uid, color):
+        self._write('delete_group', uid, color)
+
+    def _write(self, op, uid, arg):
+        rois = self.get(uid)
+        with self._lock:
+            getattr(rois, op)(arg)
+            self._pending.append((op, uid, arg))
+            self._start_flusher()
+            self._flush_needed.notify()
+
+    def _db_version(self, uid):
+        version = db.session.query(RoiScan.version).filter_by(uid=uid).scalar()
+        # End the read transaction, so the next check sees writes of other workers
+        db.session.rollback()
+        return version
+
+    def _import_legacy(self, uid):
+        rois = []
+        if self.legacy_dir is not None and os.path.isfile(os.path.join(self.legacy_dir, uid)):
+            with open(os.path.join(self.legacy_dir, uid)) as infile:
+                for line in infile:
+                    rois.append(json.loads(line))
+
+        # Saved ROI files may hold the same ROI several times
+        unique_rois = ScanRois(rois).all()
+        try:
+            db.session.add(RoiScan(uid=uid, version=0))
+            db.session.add_all(Roi.from_dict(uid, roi) for roi in unique_rois)
+            db.session.commit()
+        except IntegrityError:
+            # Another worker imported it first
+            db.session.rollback()
+
+    def _start_flusher(self):
+        # Threads do not survive a fork, so every worker process starts its own
+        if self._flusher is None or self._flusher_pid != os.getpid() or not self._flusher.is_alive():
+            self._flusher = threading.Thread(target=self._flush_loop, name='roi-flusher', daemon=True)
+            self._flusher_pid = os.getpid()
+            self._flusher.start()
+
+    def _flush_loop(self):
+        while True:
+            with self._lock:
+                while not self._pending:
+                    self._flush_needed.wait()
+            # Let more writes join this group commit
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Error writing ROIs')
+
+    def flush(self):
+        """ Commits all pending writes in a single transaction """
+        with self._lock:
+            pending, self._pending = self._pending, []
+            if not pending:
+                return
+            self._flushing.append(pending)
+
+        with self.app.app_context():
+            try:
+                ops_by_uid = collections.Counter(uid for _, uid, _ in pending)
+
+                # Bumping the versions first takes the write lock before anything is read
+                versions = {}
+                for uid, num_ops in ops_by_uid.items():
+                    updated = RoiScan.query.filter_by(uid=uid).update({RoiScan.version: RoiScan.version + num_ops})
+                    if not updated:
+                        db.session.add(RoiScan(uid=uid, version=num_ops))
+                        db.session.flush()
+                    versions[uid] = db.session.query(RoiScan.version).filter_by(uid=uid).scalar()
+
+                for op, uid, arg in pending:
+                    if op == 'add':
+                        db.session.merge(Roi.from_dict(uid, arg))
+                    elif op == 'add_many':
+                        for roi in arg:
+                            db.session.merge(Roi.from_dict(uid, roi))
+                    else:
+                        Roi.query.filter_by(scan_uid=uid, color=arg).delete()
+                db.session.commit()
+            except BaseException:
+                db.session.rollback()
+                with self._lock:
+                    self._flushing = [batch for batch in self._flushing if batch is not pending]
+                    self._pending[:0] = pending
+                raise
+
+        with self._lock:
+            self._flushing = [batch for batch in self._flushing if batch is not pending]
+            for uid, version in versions.items():
+                entry = self._scans.get(uid)
+                if entry is None:
+                    continue
+                if entry[0] is not None and entry[0] + ops_by_uid[uid] == version:
+                    entry[0] = version
+                else:
+                    # Other workers wrote in between - reload on next access
+                    entry[0] = -1
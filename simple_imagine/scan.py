@@ -3,116 +3,340 @@ import logging
 import numpy as np
 import gzip
 import common
+import files
+import metrics
+import volume_format
+import volume_codecs
+import pyramid
+import hdf5_pool
+import storage
 import h5py
+from cache import LRUCache
 
 logger = logging.getLogger(__name__)
 
+# Parsed scans by (.mat path, compressed volumes directory), with the mtime and size of their file
+parsed_scans = LRUCache(256, sizeof=lambda entry: 1)
+
 
 class Scan:
     """ scan master class that handles all volume scans operations from
           loading, handeling masks and more sophisticated ( such as brain and
-          normalization )"""
+          normalization )
+
+        Only the cheap header fields are read by fromID. metadata, body_part, plane, image_orientation and
+        is_simulated_short are read together on first access, image_positions and the volume each on
+        their own """
+    __slots__ = ('uid', 'directory', 'compressed_volume_directory', 'path', 'name', 'date', 'time', 'modality',
+                 'defWindow', 'normWindow', 'masks', 'extradata', 'roiTexts', 'size', 'dtype',
+                 '_volume', '_volume_compressed', '_volume_source', '_lazy')
 
     def __init__(self, volume=None):
         self.uid = ''
         self.directory = ''
         self.compressed_volume_directory = None
-        self.volume = volume or []  # the CT scan volume
+        self._volume = volume if volume is not None else []  # the CT scan volume
+        # Whether the volume is still to be read, preferring the compressed volume - see fromID
+        self._volume_source = None
         self.path = []
         self.name = []  # patient name or number
         self.date = []  # scan date
         self.time = []
         self.modality = []
         self.defWindow = []  # default viewing window
+        self.normWindow = []
         self.masks = []
         self.extradata = []  # costum saved user data
-        self.metadata = []
         self.roiTexts = []
         self.size = None
-        self.volume_compressed = False
-        # self.__init__()
-        # Read data
+        self.dtype = None
+        self._volume_compressed = False
+        # Lazily read fields, shared with the copies of a parsed scan
+        self._lazy = {}
 
     @classmethod
     def fromID(cls, uid, scanfolder='', read_volume=True, prefer_compressed_volume=True,
                compressed_volumes_dir=None):
-        scan = cls()
+        """ Returns the scan of uid. Parsed scans are kept in a process wide LRU cache and reused until
+            their file changes. With read_volume, the volume is read on first access of scan.volume """
         if len(scanfolder) == 0:
-            scanfolder = common.getTMpath('CTscans')
+            scanfolder = storage.default.scan_folder(uid)
+            compressed_volumes_dir = compressed_volumes_dir or storage.default.volume_folder(uid, scanfolder)
 
-        filename = common.string2hash(uid)
+        filename = scan_path(uid, scanfolder)
+        try:
+            stat = os.stat(filename)
+        except OSError as err:
+            raise IOError("Could not find file" + filename) from err
+
+        compressed_volume_directory = compressed_volumes_dir or scanfolder
+        key = (filename, compressed_volume_directory)
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        cached = parsed_scans.get(key)
+        if cached is not None and cached[0] == stamp:
+            parsed = cached[1]
+        else:
+            parsed = cls._parse(uid, filename, scanfolder, compressed_volume_directory)
+            parsed_scans.put(key, (stamp, parsed))
 
-        filename = os.path.join(scanfolder, filename + '.mat')
+        # Copies share the lazily read fields of the cached scan, but not its volume
+        scan = parsed.copy()
+        if read_volume:
+            scan._volume_source = prefer_compressed_volume
+        return scan
 
-        if not os.path.isfile(filename):
-            raise IOError("Could not find file" + filename)
+    @classmethod
+    def _parse(cls, uid, filename, scanfolder, compressed_volume_directory):
+        scan = cls()
+        with hdf5_pool.open_file(filename) as rawScan:
+            if 'volume' not in rawScan:
+                raise IOError("Invalid scan in file " + filename)
+
+            scan.uid = uid
+            scan.directory = scanfolder
+            scan.path = filename
+            scan.dtype = rawScan['volume'].dtype
+            scan.compressed_volume_directory = compressed_volume_directory
+            with metrics.timer('header'):
+                scan.name = rawScan['name'][()].tobytes().decode('utf-16')
+                scan.defWindow = rawScan['defWindow'][()]
+                scan.normWindow = scan.defWindow + rawScan['matlabWindowShift'][()]
+
+                if 'size' not in rawScan:
+                    logger.warning('CTscan is missing the "size" field - computing from volume')
+                    # Volume shape is read as (slice, columns, rows). We want to reorder it to (slice, rows, columns)
+                    scan.size = rawScan['volume'].shape
+                    scan.size = [scan.size[0], scan.size[2], scan.size[1]]
+                else:
+                    # The size is read as (rows, columns, slices). To match the volume, we change it to (slices, rows, colums)
+                    scan.size = rawScan['size'][()].flatten().astype(np.uint16)
+                    scan.size = [scan.size[2], scan.size[0], scan.size[1]]
 
-        rawScan = h5py.File(filename)
+        return scan
 
-        if 'volume' not in rawScan:
-            raise IOError("Invalid scan in file " + filename)
+    def copy(self):
+        scan = Scan.__new__(type(self))
+        for name in Scan.__slots__:
+            setattr(scan, name, getattr(self, name))
+        return scan
 
-        scan.uid = uid
-        scan.directory = scanfolder
-        scan.compressed_volume_directory = compressed_volumes_dir or scanfolder
-        scan.name = rawScan['name'].value.tostring().decode('utf-16')
-        scan.defWindow = rawScan['defWindow'].value
-        scan.normWindow = rawScan['defWindow'].value + rawScan['matlabWindowShift'].value
-        scan.metadata = _read_metadata(rawScan, rawScan['metadata'])
-        scan.body_part = _get_body_part(rawScan)
-        try:
-            scan.plane = _get_plane(rawScan)
-        except Exception as e:
-            if scan.body_part == 'brain':
-                # We can assume the scan is axial
-                logger.warning('uid %s: %s - assuming Axial', uid, str(e))
-                scan.plane = 'axial'
-            else:
-                raise e
-
-        scan.image_orientation = scan.metadata['ImageOrientationPatient'].tolist()
-
-        if 'size' not in rawScan:
-            logger.warning('CTscan is missing the "size" field - computing from volume')
+    def _header(self):
+        lazy = self._lazy
+        if 'metadata' not in lazy:
+            with metrics.timer('metadata'), hdf5_pool.open_file(self.path) as rawScan:
+                metadata = _read_metadata(rawScan, rawScan['metadata'])
+                body_part = _get_body_part(rawScan)
+                try:
+                    plane = _get_plane(rawScan)
+                except Exception as e:
+                    if body_part == 'brain':
+                        # We can assume the scan is axial
+                        logger.warning('uid %s: %s - assuming Axial', self.uid, str(e))
+                        plane = 'axial'
+                    else:
+                        raise e
+
+                # Brain scans may require down-sampling
+                is_simulated_short = body_part == 'brain' and _is_simulated_short_scan(rawScan)
+
+            # metadata goes last, since it marks the fields as read
+            lazy.update(body_part=body_part, plane=plane, is_simulated_short=is_simulated_short,
+                        image_orientation=metadata['ImageOrientationPatient'].tolist(), metadata=metadata)
+        return lazy
+
+    @property
+    def metadata(self):
+        return self._header()['metadata']
+
+    @property
+    def body_part(self):
+        return self._header()['body_part']
+
+    @property
+    def plane(self):
+        return self._header()['plane']
+
+    @property
+    def image_orientation(self):
+        return self._header()['image_orientation']
+
+    @property
+    def is_simulated_short(self):
+        return self._header()['is_simulated_short']
+
+    @property
+    def stores_slice_subset(self):
+        """ Whether the stored compressed volumes hold only every 4th slice of the volume """
+        return self.body_part == 'brain' and self.is_simulated_short
+
+    @property
+    def image_positions(self):
+        return self._image_positions()
+
+    def _image_positions(self):
+        lazy = self._lazy
+        if 'image_positions' not in lazy:
+            metadata, plane = self.metadata, self.plane
+            with metrics.timer('positions'), hdf5_pool.open_file(self.path) as rawScan:
+                try:
+                    image_positions = _read_image_positions(rawScan, self.size[0], plane, metadata)
+                except Exception as e:
+                    logger.warning('uid %s: %s', self.uid, str(e))
+                    image_positions = []
+            lazy['image_positions'] = image_positions
+        return lazy['image_positions']
+
+    def load_header(self):
+        """ Reads all lazily read header fields, as the worklist and the viewer use them """
+        self._header()
+        self._image_positions()
+
+    @property
+    def volume(self):
+        self._read_pending_volume()
+        return self._volume
+
+    @volume.setter
+    def volume(self, volume):
+        self._volume_source = None
+        self._volume = volume
+
+    @property
+    def volume_compressed(self):
+        """ Whether the volume was read from the stored compressed volume """
+        self._read_pending_volume()
+        return self._volume_compressed
+
+    def _read_pending_volume(self):
+        if self._volume_source is None:
+            return
+        prefer_compressed_volume = self._volume_source
+        self._volume_source = None
+
+        volume = None
+        if prefer_compressed_volume:
+            try:
+                with metrics.timer('volume'):
+                    volume = _read_compressed_volume(self.uid, self.compressed_volume_directory, self.dtype,
+                                                     self.size)
+            except Exception:
+                logger.exception('uid %s: Error reading compressed volume', self.uid)
+                volume = None
+
+        if volume is None:
+            with metrics.timer('volume'), hdf5_pool.open_file(self.path) as rawScan:
+                volume = rawScan['volume'][()]
             # Volume shape is read as (slice, columns, rows). We want to reorder it to (slice, rows, columns)
-            scan.size = rawScan['volume'].shape
-            scan.size = [scan.size[0], scan.size[2], scan.size[1]]
+            self._volume = np.transpose(volume, (0, 2, 1))
+            self._volume_compressed = False
         else:
-            # The size is read as (rows, columns, slices). To match the volume, we change it to (slices, rows, colums)
-            scan.size = rawScan['size'].value.flatten().astype(np.uint16)
-            scan.size = [scan.size[2], scan.size[0], scan.size[1]]
-
-        try:
-            scan.image_positions = _read_image_positions(rawScan, scan.size[0], scan.plane)
-        except Exception as e:
-            logger.warning('uid %s: %s', uid, str(e))
-            scan.image_positions = []
-
-        if scan.body_part == 'brain':
-            # Brain scans may require down-sampling
-            scan.is_simulated_short = _is_simulated_short_scan(rawScan)
-        else:
-            scan.is_simulated_short = False
-
+            self._volume = volume
+            self._volume_compressed = True
+
+    def slice_nbytes(self):
+        return int(self.size[1]) * int(self.size[2]) * self.dtype.itemsize
+
+    def slice_spacing(self, num_slices=None):
+        """ Distance in mm between consecutive slices of a volume of num_slices slices spanning the scan,
+            which defaults to the number of acquired slices. The image positions are preferred over
+            SpacingBetweenSlices, which is unreliable, and SliceThickness is the last resort """
+        num_slices = num_slices or int(self.size[0])
+        positions = np.asarray(self.image_positions, dtype=np.float64)
+        if len(positions) > 1 and num_slices > 1:
+            steps = np.linalg.norm(np.diff(positions, axis=0), axis=1)
+            if np.median(steps) > 0:
+                # Stored volumes may keep every n-th slice only
+                return float(np.median(steps)) * (len(positions) - 1) / (num_slices - 1)
+
+        spacing = self.metadata.get('SpacingBetweenSlices') or self.metadata.get('SliceThickness') or 1.0
+        return float(spacing) * int(self.size[0]) / num_slices
+
+    def open_chunked_volume(self, level=1):
+        """ Returns a reader of the stored chunked volume, or of one of its pyramid levels, or None
+            if the scan has none """
+        chunked_volume_file = chunked_volume_path(self.uid, self.compressed_volume_directory, level)
+        if os.path.isfile(chunked_volume_file):
+            return volume_format.VolumeReader(chunked_volume_file)
+        return None
+
+    def open_packed_volume(self):
+        """ Returns a reader of the stored packed volume, or None if the scan has none """
+        packed_volume_file = packed_volume_path(self.uid, self.compressed_volume_directory)
+        if os.path.isfile(packed_volume_file):
+            return volume_format.VolumeReader(packed_volume_file)
+        return None
+
+    def _open_level(self, level):
+        reader = self.open_chunked_volume(level)
+        if reader is not None and reader.source != self._level_source():
+            # Built from a previous version of the scan
+            reader.close()
+            reader = None
+        if reader is None:
+            # Pyramid levels are built lazily on first access
+            self.store_pyramid()
+            reader = self.open_chunked_volume(level)
+        return reader
+
+    def _level_source(self):
+        # Pyramid levels are not part of the validator, so building them leaves it unchanged
+        return scan_validator(self.uid, self.directory, self.compressed_volume_directory)[0]
+
+    def stored_shape(self, level=1):
+        """ Shape (slices, rows, columns) of the volume that is served for this scan """
+        if level != 1:
+            with self._open_level(level) as reader:
+                return reader.shape
+
+        reader = self.open_chunked_volume() or self.open_packed_volume()
+        if reader is not None:
+            with reader:
+                return reader.shape
+        return int(self.size[0]), int(self.size[1]), int(self.size[2])
+
+    def _iter_slice_arrays(self, start, stop, level=1):
+        if level == 1 and isinstance(self.volume, np.ndarray) and len(self.volume) > 0:
+            # An already decoded volume, such as a memory map from the volume cache
+            for slice_data in self.volume[start:stop]:
+                yield slice_data
+            return
 
-        if read_volume:
-            scan.volume = None
-            compressed_volume_file = os.path.join(scan.compressed_volume_directory, common.string2hash(uid) + '.dat.gz')
-            if prefer_compressed_volume and os.path.isfile(compressed_volume_file):
-                try:
-                    with open(compressed_volume_file, 'rb') as f:
-                        scan.volume = f.read()
-                    scan.volume_compressed = True
-                except Exception:
-                    logger.exception('uid %s: Error reading compressed volume', uid)
-
-            if not scan.volume:
-                scan.volume = rawScan['volume']
-                # Volume shape is read as (slice, columns, rows). We want to reorder it to (slice, rows, columns)
-                scan.volume = np.transpose(scan.volume, (0, 2, 1))
-                scan.volume_compressed = False
+        reader = self._open_level(level) if level != 1 else self.open_chunked_volume()
+        if reader is None and level == 1 and start == 0 and stop is None:
+            # A packed volume is a single block, which only pays off when the whole volume is read
+            reader = self.open_packed_volume()
+        if reader is not None:
+            with reader:
+                for slice_data in reader.iter_slices(start, stop):
+                    yield slice_data
+            return
 
-        return scan
+        with hdf5_pool.open_file(self.path) as rawScan:
+            dataset = rawScan['volume']
+            start, stop, _ = slice(start, stop).indices(dataset.shape[0])
+            for idx in range(start, stop):
+                # Slice shape is read as (columns, rows). We want to reorder it to (rows, columns)
+                yield np.ascontiguousarray(dataset[idx].T)
+
+    def iter_slices(self, start=0, stop=None, level=1):
+        """ Yields the raw bytes of slices [start, stop). Slices come from the chunked volume if one is
+            stored, otherwise from one HDF5 hyperslab at a time, so only one slice is held in memory """
+        for slice_data in self._iter_slice_arrays(start, stop, level):
+            yield slice_data.tobytes()
+
+    def read_slices(self, start=0, stop=None, level=1):
+        """ Reads slices [start, stop) as a (slices, rows, columns) array """
+        slices = list(self._iter_slice_arrays(start, stop, level))
+        if not slices:
+            return np.empty((0,) + tuple(self.stored_shape(level)[1:]), dtype=self.dtype)
+        return np.stack(slices)
+
+    def store_pyramid(self, levels=pyramid.levels, slab=8, compresslevel=6):
+        """ Stores reduced resolution levels of the served volume, reading it one slab at a time """
+        paths = {level: chunked_volume_path(self.uid, self.compressed_volume_directory, level) for level in levels}
+        pyramid.build(self._iter_slice_arrays(0, None), self.stored_shape(), self.dtype, paths,
+                      rescale=self.rescale(), plane=self.plane, slab=slab, compresslevel=compresslevel,
+                      source=self._level_source())
 
     def getMask(self, idx):
         if idx < len(self.masks):
@@ -131,27 +355,144 @@ class Scan:
         return (photometric_interpretation in ['RGB', 'PALETTE COLOR', 'YBR_FULL', 'YBR_FULL_422', 'YBR_PARTIAL_422',
                                                'YBR_PARTIAL_420', 'YBR_RCT', 'YBR_ICT'])
 
-    def store_compressed_volume(self):
+    def volume_to_store(self):
+        """ The volume as the compressed volumes store it, every 4th slice when stores_slice_subset """
+        if self.stores_slice_subset:
+            return self.volume[::4]
+        return self.volume
+
+    def rescale(self):
+        """ Slope and intercept that map stored values to HU """
+        return self.metadata.get('RescaleSlope', 1.0), self.metadata.get('RescaleIntercept', 0.0)
+
+    def store_compressed_volume(self, compresslevel=9, codec=None):
+        """ Stores the whole volume with a volume_codecs codec spec, gzip by default. Plain gzip volumes are
+            stored as .dat.gz, which browsers inflate themselves. Any other codec is stored as a single
+            block .dat.vol, whose header records the codec. The other format is kept while it is current """
         if len(self.volume) == 0 or self.volume_compressed:
             return
 
-        volume = self.volume
-        if self.body_part == 'brain' and self.is_simulated_short:
-            volume = volume[::4]
+        codec = volume_codecs.get_codec(codec or 'gzip', level=compresslevel)
+        volume = self.volume_to_store()
+
+        compressed_volume_file = compressed_volume_path(self.uid, self.compressed_volume_directory)
+        packed_volume_file = packed_volume_path(self.uid, self.compressed_volume_directory)
+        if codec.name == 'gzip' and not codec.filters:
+            with files.replacing(compressed_volume_file) as tmp_file, open(tmp_file, 'wb') as f:
+                gzip_file = gzip.GzipFile(mode='wb', fileobj=f, compresslevel=codec.level)
+                gzip_file.write(volume.tobytes())
+                gzip_file.close()
+            other_file = packed_volume_file
+        else:
+            volume_format.write_volume(packed_volume_file, volume, rescale=self.rescale(), plane=self.plane,
+                                       slab=max(len(volume), 1), codec=codec)
+            other_file = compressed_volume_file
+
+        # The .dat.gz is served by the gzip fast path and the .dat.vol is read first, so both are kept while
+        # they are newer than the .mat. An older one is outdated, and removed so that readers never pick it
+        try:
+            if os.path.getmtime(other_file) <= os.path.getmtime(self.path):
+                os.remove(other_file)
+        except FileNotFoundError:
+            pass
+        return volume.nbytes
+
+    def store_chunked_volume(self, slab=1, compresslevel=6, codec=None):
+        if len(self.volume) == 0 or self.volume_compressed:
+            return
+
+        volume = self.volume_to_store()
+        volume_format.write_volume(chunked_volume_path(self.uid, self.compressed_volume_directory), volume,
+                                   rescale=self.rescale(), plane=self.plane, slab=slab, compresslevel=compresslevel,
+                                   codec=codec)
+        return volume.nbytes
+
+    def convert_compressed_volume(self, slab=1, compresslevel=6, codec=None):
+        """ Converts the stored .dat.gz volume into a chunked volume without reading the HDF5 volume """
+        num_slices = int(self.size[0])
+        if self.stores_slice_subset:
+            num_slices = len(range(0, num_slices, 4))
+        shape = (num_slices, int(self.size[1]), int(self.size[2]))
+
+        volume_format.convert_dat_gz(compressed_volume_path(self.uid, self.compressed_volume_directory),
+                                     chunked_volume_path(self.uid, self.compressed_volume_directory), shape,
+                                     self.dtype, rescale=self.rescale(), plane=self.plane, slab=slab,
+                                     compresslevel=compresslevel, codec=codec)
+        return num_slices * self.slice_nbytes()
+
+
+def scan_path(uid, scanfolder=''):
+    if len(scanfolder) == 0:
+        scanfolder = storage.default.scan_folder(uid)
+    return os.path.join(scanfolder, common.string2hash(uid) + '.mat')
+
+
+def scan_validator(uid, scanfolder='', compressed_volumes_dir=None):
+    """ Returns a strong validator of the volumes served for a scan and their last modification time.
+        Both are derived from the mtime and size of the .mat and the stored volumes, without opening them """
+    if len(scanfolder) == 0:
+        scanfolder = storage.default.scan_folder(uid)
+        compressed_volumes_dir = compressed_volumes_dir or storage.default.volume_folder(uid, scanfolder)
+    compressed_volumes_dir = compressed_volumes_dir or scanfolder
+
+    parts = [common.string2hash(uid)]
+    last_modified = None
+    for path in [scan_path(uid, scanfolder), compressed_volume_path(uid, compressed_volumes_dir),
+                 packed_volume_path(uid, compressed_volumes_dir), chunked_volume_path(uid, compressed_volumes_dir)]:
+        try:
+            stat = os.stat(path)
+        except OSError as err:
+            if last_modified is None:
+                raise IOError("Could not find file" + path) from err
+            continue
+        parts.append('%x-%x' % (stat.st_mtime_ns, stat.st_size))
+        last_modified = max(last_modified or 0, stat.st_mtime)
+
+    return '-'.join(parts), last_modified
+
+
+def compressed_volume_path(uid, compressed_volumes_dir=None):
+    if compressed_volumes_dir is None:
+        compressed_volumes_dir = storage.default.volume_folder(uid)
+    return os.path.join(compressed_volumes_dir, common.string2hash(uid) + '.dat.gz')
+
 
-        compressed_volume_file = os.path.join(self.compressed_volume_directory,
-                                              common.string2hash(self.uid) + '.dat.gz')
-        with open(compressed_volume_file, 'wb') as f:
-            gzip_file = gzip.GzipFile(mode='wb', fileobj=f, compresslevel=9)
-            gzip_file.write(volume.tobytes())
-            gzip_file.close()
+def packed_volume_path(uid, compressed_volumes_dir=None):
+    if compressed_volumes_dir is None:
+        compressed_volumes_dir = storage.default.volume_folder(uid)
+    return os.path.join(compressed_volumes_dir, common.string2hash(uid) + '.dat.vol')
+
+
+def _read_compressed_volume(uid, compressed_volumes_dir, dtype, size):
+    """ Decodes the stored compressed volume of a scan with the codec it was written with, or returns None
+        if there is none """
+    packed_volume_file = packed_volume_path(uid, compressed_volumes_dir)
+    if os.path.isfile(packed_volume_file):
+        with volume_format.VolumeReader(packed_volume_file) as reader:
+            return reader.read_slices()
+
+    compressed_volume_file = compressed_volume_path(uid, compressed_volumes_dir)
+    if os.path.isfile(compressed_volume_file):
+        with open(compressed_volume_file, 'rb') as f:
+            data = f.read()
+        # .dat.gz volumes are headerless - the slice count differs from size for simulated short scans
+        return volume_codecs.get_codec('gzip').decode(data, dtype, (-1, int(size[1]), int(size[2])))
+    return None
+
+
+def chunked_volume_path(uid, compressed_volumes_dir=None, level=1):
+    if compressed_volumes_dir is None:
+        compressed_volumes_dir = storage.default.volume_folder(uid)
+    if level != 1:
+        return os.path.join(compressed_volumes_dir, common.string2hash(uid) + '.L%d.vol' % level)
+    return os.path.join(compressed_volumes_dir, common.string2hash(uid) + '.vol')
 
 
 def _read_metadata(rawScan, rawMetadata):
     metadata = {}
     metadataKeys = rawMetadata.keys()
     extraData = rawScan['extraData']
-    metadata['PhotometricInterpretation'] = rawMetadata['PhotometricInterpretation'].value.tostring().decode('utf-16')
+    metadata['PhotometricInterpretation'] = rawMetadata['PhotometricInterpretation'][()].tobytes().decode('utf-16')
 
     if 'AN' in extraData and extraData['AN']:
         metadata['AccessionNumber'] = _get_hdf5_string(extraData['AN'])
@@ -162,25 +503,25 @@ def _read_metadata(rawScan, rawMetadata):
         metadata['StudyInstanceUID'] = _get_hdf5_string(rawMetadata['StudyInstanceUID'])
 
     if 'RescaleSlope' in metadataKeys:
-        metadata['RescaleSlope'] = np.asscalar(rawMetadata['RescaleSlope'].value)
+        metadata['RescaleSlope'] = rawMetadata['RescaleSlope'][()].item()
 
     if 'RescaleIntercept' in metadataKeys:
-        metadata['RescaleIntercept'] = np.asscalar(rawMetadata['RescaleIntercept'].value)
+        metadata['RescaleIntercept'] = rawMetadata['RescaleIntercept'][()].item()
 
     if 'PixelSpacing' in metadataKeys:
-        metadata['PixelSpacing'] = rawMetadata['PixelSpacing'].value[0]
+        metadata['PixelSpacing'] = rawMetadata['PixelSpacing'][0]
 
     if 'SliceThickness' in metadataKeys:
-        metadata['SliceThickness'] = np.asscalar(rawMetadata['SliceThickness'].value)
+        metadata['SliceThickness'] = rawMetadata['SliceThickness'][()].item()
 
     if 'SpacingBetweenSlices' in metadataKeys:
-        metadata['SpacingBetweenSlices'] = np.asscalar(rawMetadata['SpacingBetweenSlices'].value)
+        metadata['SpacingBetweenSlices'] = rawMetadata['SpacingBetweenSlices'][()].item()
 
     if 'ImageOrientationPatient' in metadataKeys:
-        metadata['ImageOrientationPatient'] = rawMetadata['ImageOrientationPatient'].value[0]
+        metadata['ImageOrientationPatient'] = rawMetadata['ImageOrientationPatient'][0]
 
     if 'ImagePositionPatient' in metadataKeys:
-        metadata['ImagePositionPatient'] = rawMetadata['ImagePositionPatient'].value[0]
+        metadata['ImagePositionPatient'] = rawMetadata['ImagePositionPatient'][0]
 
     if 'FrameOfReferenceUID' in metadataKeys:
         metadata['FrameOfReferenceUID'] = _get_hdf5_string(rawMetadata['FrameOfReferenceUID'])
@@ -189,11 +530,11 @@ def _read_metadata(rawScan, rawMetadata):
 
 
 def _get_hdf5_string(hdf5_element):
-    char_array = hdf5_element.value
+    char_array = hdf5_element[()]
     if np.max(char_array) < 20:
         return ''
     else:
-        return char_array.tostring().decode('utf-16')
+        return char_array.tobytes().decode('utf-16')
 
 
 def _get_body_part(rawScan):
@@ -231,62 +572,59 @@ def _is_simulated_short_scan(rawScan):
 
     if 'specialmarks' not in extraData:
         return True
-    else:
-        for ind, text_cell in enumerate(extraData['specialmarks']):
-            if isinstance(text_cell.item(), int):  # Happens when specialmarks is an empty cell array
-                return True
 
-            decoded = rawScan[text_cell.item()].value.tostring().decode('utf-16')
-            if 'short' in decoded:
-                return False
+    special_marks = _parse_cell_of_strings(extraData, 'specialmarks', rawScan)
+    return not any('short' in mark for mark in special_marks)
 
-        return True
 
+def _read_cell_refs(dataset):
+    """ Reads all the object references of a cell array at once. Returns None when the cell array
+        is empty, in which case MATLAB stores plain integers instead of references """
+    cells = dataset[()].flatten()
+    if h5py.check_dtype(ref=cells.dtype) is None:
+        return None
+    return cells
 
-def _parse_cell_of_strings(dataset, key, rawScan):
-    values = []
-    for text_cell in dataset[key]:
-        if isinstance(text_cell.item(), int):  # Happens when the key contains an empty cell array
-            return []
 
-        decoded = _get_hdf5_string(rawScan[text_cell.item()])
-        values.append(decoded)
+def _parse_cell_of_strings(dataset, key, rawScan):
+    refs = _read_cell_refs(dataset[key])
+    if refs is None:
+        return []
 
-    return values
+    return [_get_hdf5_string(rawScan[ref]) for ref in refs]
 
 
 def _is_empty_metadata(metadata_obj):
-    if isinstance(metadata_obj, h5py._hl.group.Group) and len(metadata_obj) > 0:
+    if isinstance(metadata_obj, h5py.Group) and len(metadata_obj) > 0:
         return False
-    if isinstance(metadata_obj, h5py._hl.dataset.Dataset):
-        l = metadata_obj.size
-        for i in range(l):
-            if not metadata_obj[i] == 0:
-                return False
+    if isinstance(metadata_obj, h5py.Dataset):
+        return not np.any(metadata_obj[()])
     else:
         raise Exception('Unknown type of all_metadata field')
-    return True
-
 
-def _read_image_positions(rawScan, num_slices, plane):
-    image_positions = []
 
+def _read_image_positions(rawScan, num_slices, plane, metadata):
     if 'all_metadata' in rawScan and not (_is_empty_metadata(rawScan['all_metadata'])):
-        all_metadata = rawScan['all_metadata']
-        image_positions_refs = all_metadata['ImagePositionPatient']
-        for ref in image_positions_refs:
-            image_position = rawScan[ref[0]].value[0]
-            image_positions.append(image_position.tolist())
+        refs = _read_cell_refs(rawScan['all_metadata']['ImagePositionPatient'])
+        image_positions = np.empty((len(refs), 3))
+        if len(refs) > 0 and rawScan[refs[0]].shape == (1, 3):
+            # Read every 1x3 position straight into its row, skipping the high level dataset objects
+            file_id = rawScan.id
+            for i, ref in enumerate(refs):
+                h5py.h5r.dereference(ref, file_id).read(h5py.h5s.ALL, h5py.h5s.ALL, image_positions[i:i + 1])
+        else:
+            for i, ref in enumerate(refs):
+                image_positions[i] = rawScan[ref][0]
+        image_positions = image_positions.tolist()
     else:
-        first_slice_metadata = _read_metadata(rawScan, rawScan['metadata'])
-        if 'SpacingBetweenSlices' not in first_slice_metadata:
+        if 'SpacingBetweenSlices' not in metadata:
             raise Exception('Cannot obtain image position patient info for all slices')
 
         # Try to guess the image positions for all slices by using SpacingBetweenSlices
         # Note that this isn't accurate and might not even be correct since SpacingBetweenSlices is unreliable
         # TODO: Try to use the first and last slices' metadata to get a more accurate image position
-        slice_spacing = first_slice_metadata['SpacingBetweenSlices']
-        first_slice_position = np.array(first_slice_metadata['ImagePositionPatient'])
+        slice_spacing = metadata['SpacingBetweenSlices']
+        first_slice_position = np.array(metadata['ImagePositionPatient'], dtype=np.float64)
 
         if plane == 'axial':
             z_idx = 2
@@ -297,10 +635,9 @@ def _read_image_positions(rawScan, num_slices, plane):
         else:
             raise Exception('Unknown orientation: ' + plane)
 
-        for i in np.arange(num_slices):
-            slice_position = np.array(first_slice_position)
-            slice_position[z_idx] += i * slice_spacing
-            image_positions.append(slice_position)
+        image_positions = np.tile(first_slice_position, (num_slices, 1))
+        image_positions[:, z_idx] += np.arange(num_slices) * slice_spacing
+        image_positions = list(image_positions)
 
     # if 'lastSliceInfo' not in rawScan['metadata']:
     #     raise Exception('Cannot obtain image position patient info for all slices')
@@ -0,0 +1,36 @@
+""" Thick-slab reconstructions of a volume. A slab combines consecutive slices into one, by their mean
+    (average), their maximum (MIP) or their minimum (MinIP), and slabs start every step slices """
+import numpy as np
+
+modes = {'avg': np.mean, 'mip': np.max, 'minip': np.min}
+
+
+def slab_geometry(spacing, thickness, step=None):
+    """ Returns (slices per slab, slices between slab starts) for a thickness and step in mm. step defaults
+        to the thickness, so that slabs are contiguous """
+    slices_per_slab = max(1, int(round(thickness / spacing)))
+    if step is None:
+        return slices_per_slab, slices_per_slab
+    return slices_per_slab, max(1, int(round(step / spacing)))
+
+
+def num_slabs(num_slices, slices_per_slab, stride):
+    return max(num_slices - slices_per_slab, 0) // stride + 1
+
+
+def reconstruct(volume, mode, slices_per_slab, stride, start=0, stop=None):
+    """ Returns slabs [start, stop) of a (slices, rows, columns) volume as a (slabs, rows, columns) array of
+        the volume dtype. Only whole slabs are returned. Each slab is reduced over its slices in one numpy
+        call, reading only those slices, so volume may be a memory map """
+    reduce = modes[mode]
+    start, stop, _ = slice(start, stop).indices(num_slabs(len(volume), slices_per_slab, stride))
+    slabs = np.empty((max(stop - start, 0),) + tuple(volume.shape[1:]), dtype=volume.dtype)
+    integer = np.issubdtype(volume.dtype, np.integer)
+    for i, first in enumerate(range(start * stride, stop * stride, stride)):
+        slices = volume[first:first + slices_per_slab]
+        if mode == 'avg':
+            reduced = reduce(slices, axis=0, dtype=np.float32)
+            slabs[i] = np.rint(reduced) if integer else reduced
+        else:
+            reduce(slices, axis=0, out=slabs[i])
+    return slabs
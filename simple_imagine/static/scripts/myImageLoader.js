@@ -4,16 +4,46 @@
 
 
     var scanImages = [];
+    // HU statistics and suggested windows of the scan, from /stats
+    var scanStats = null;
+    var defaultWindowCenter = 70, defaultWindowWidth = 50;
+
+    // Sets the pixel value range, rescale and window of an image from the statistics
+    function applyStats(image, slice) {
+        var slope = scanStats.rescale[0];
+        var intercept = scanStats.rescale[1];
+        // The statistics are in HU, pixel values are stored values
+        var low = (scanStats.slices.min[slice] - intercept) / slope;
+        var high = (scanStats.slices.max[slice] - intercept) / slope;
+        var window = scanStats.windows['default'] || scanStats.windows.tissue || scanStats.windows.full;
+        image.minPixelValue = Math.min(low, high);
+        image.maxPixelValue = Math.max(low, high);
+        image.slope = slope;
+        image.intercept = intercept;
+        image.windowCenter = window[0];
+        image.windowWidth = window[1];
+    }
 
-    function createImageObjects(imageId, image_data) {
-        var volume = new Uint16Array(image_data);
-        var width = scan_md.width;
-        var height = scan_md.height;
-
-        var sliceSize = width * height;
-        for (var i = 0; i < scan_md.slices; i++) {
-            var sliceVolume = volume.subarray(i * sliceSize, (i * sliceSize) + sliceSize);
-            createImageObject("aidoc://" + scan_md.uid + "/" + i,i,sliceVolume);
+    // Applies the statistics to the images streamed before they arrived, and to the viewports showing
+    // them that still have the default window
+    function receiveStats(uid, stats) {
+        scanStats = stats;
+        for (var slice = 0; slice < scanImages.length; slice++) {
+            if (scanImages[slice]) {
+                applyStats(scanImages[slice], slice);
+            }
+        }
+        var enabledElements = cs.getEnabledElements();
+        for (var i = 0; i < enabledElements.length; i++) {
+            var enabledElement = enabledElements[i];
+            var image = enabledElement.image;
+            var voi = enabledElement.viewport && enabledElement.viewport.voi;
+            if (image && voi && image.imageId.indexOf("aidoc://" + uid + "/") === 0 &&
+                voi.windowCenter === defaultWindowCenter && voi.windowWidth === defaultWindowWidth) {
+                voi.windowCenter = image.windowCenter;
+                voi.windowWidth = image.windowWidth;
+                cs.updateImage(enabledElement.element);
+            }
         }
     }
 
@@ -22,15 +52,15 @@
         var width = scan_md.width;
         var height = scan_md.height;
 
-
         scanImages[slice] = {
             imageId: imageId,
+            // Until the statistics arrive
             minPixelValue: -1000,
             maxPixelValue: 4000,
             slope: 1.0,
             intercept: 0,
-            windowCenter: 70,
-            windowWidth: 50,
+            windowCenter: defaultWindowCenter,
+            windowWidth: defaultWindowWidth,
             render: cs.renderGrayscaleImage,
             getPixelData: function () {
                 return slice_volume;
@@ -44,8 +74,86 @@
             rowPixelSpacing: .8984375,
             sizeInBytes: width * height * 2
         };
+        if (scanStats) {
+            applyStats(scanImages[slice], slice);
+        }
+    }
+
+
+    var pendingSlices = {};
+    var volumeRequested = false;
+
+    function resolvePendingSlice(slice) {
+        var deferreds = pendingSlices[slice] || [];
+        for (var i = 0; i < deferreds.length; i++) {
+            deferreds[i].resolve(scanImages[slice]);
+        }
+        delete pendingSlices[slice];
+    }
+
+    function rejectPendingSlices(error) {
+        for (var slice in pendingSlices) {
+            var deferreds = pendingSlices[slice];
+            for (var i = 0; i < deferreds.length; i++) {
+                deferreds[i].reject({error: error});
+            }
+        }
+        pendingSlices = {};
+        volumeRequested = false;
     }
 
+    // Streams the volume slice by slice, so each slice can be rendered as soon as its bytes arrive
+    function streamVolume(uid) {
+        var sliceSize = scan_md.width * scan_md.height * 2;
+        var sliceBytes = new Uint8Array(sliceSize);
+        var filled = 0;
+        var slice = 0;
+
+        // Slices are not held back for the statistics: they start with the default window
+        fetch("../stats/" + uid).then(function (response) {
+            return response.ok ? response.json() : null;
+        }).catch(function () {
+            return null;
+        }).then(function (stats) {
+            if (stats) {
+                receiveStats(uid, stats);
+            }
+        });
+
+        fetch("../get-scan/" + uid + "/slices?start=0&stop=" + scan_md.slices).then(function (response) {
+            if (!response.ok) {
+                throw response.statusText;
+            }
+            var reader = response.body.getReader();
+
+            function pump() {
+                return reader.read().then(function (result) {
+                    if (result.done) {
+                        return;
+                    }
+                    var chunk = result.value;
+                    var offset = 0;
+                    while (offset < chunk.length) {
+                        var n = Math.min(sliceSize - filled, chunk.length - offset);
+                        sliceBytes.set(chunk.subarray(offset, offset + n), filled);
+                        filled += n;
+                        offset += n;
+
+                        if (filled === sliceSize) {
+                            createImageObject("aidoc://" + uid + "/" + slice, slice, new Uint16Array(sliceBytes.buffer));
+                            resolvePendingSlice(slice);
+                            sliceBytes = new Uint8Array(sliceSize);
+                            filled = 0;
+                            slice++;
+                        }
+                    }
+                    return pump();
+                });
+            }
+
+            return pump();
+        }).catch(rejectPendingSlices);
+    }
 
     function loadImage(imageId) {
 
@@ -57,37 +165,19 @@
         if (parts.length > 3)
             slice = parseInt(parts[3]);
 
-
-        // create a deferred object
-        var deferred = $.Deferred();
-
         if (scanImages[slice]) {
-            // deferred.resolve(scanImages[slice]);
             return $.when(scanImages[slice]);
         }
 
-        // Make the request for the DICOM data
-        var oReq = new XMLHttpRequest();
-        oReq.open("get", "../get-scan/" + uid, true);
-        oReq.responseType = "arraybuffer";
-        oReq.onreadystatechange = function (oEvent) {
-            if (oReq.readyState === 4) {
-                if (oReq.status == 200) {
-                    // request succeeded, create an image object and resolve the deferred
-                    // Code to parse the response and return an image object omitted.....
-                    // var image = createImageObject(imageId, slice, oReq.response);
-                    createImageObjects(imageId,  oReq.response);
-                    // return the image object by resolving the deferred
-                    deferred.resolve(scanImages[slice]);
-                }
-                else {
-                    // an error occurred, return an object describing the error by rejecting
-                    // the deferred
-                    deferred.reject({error: oReq.statusText});
-                }
-            }
-        };
-        oReq.send();
+        // create a deferred object, resolved once the slice has been streamed
+        var deferred = $.Deferred();
+        pendingSlices[slice] = pendingSlices[slice] || [];
+        pendingSlices[slice].push(deferred);
+
+        if (!volumeRequested) {
+            volumeRequested = true;
+            streamVolume(uid);
+        }
 
         // return the pending deferred object to cornerstone so it can setup callbacks to be
         // invoked asynchronously for the success/resolve and failure/reject scenarios.
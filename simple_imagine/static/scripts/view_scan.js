@@ -25,10 +25,9 @@ loadScan = function () {
 
         var enabledElement = cornerstone.getEnabledElement(element);
 
-        $.get("/get-rois/" + scan_md.uid + "/" + stack.currentImageIdIndex, function (data) {
-            console.log(data);
+        withSliceRois(stack.currentImageIdIndex, function (data) {
 
-            for (i = 0; i < data.length; i++) {
+            for (var i = 0; i < data.length; i++) {
                 var roi = data[i];
 
                 drawROI(enabledElement, roi['x'], roi['y'], roi['w'], roi['h'], roi['color']);
@@ -65,10 +64,16 @@ $('#dicomImage').on("CornerstoneToolsMouseUp", function (e, eventData) {
     };
 
 
-    $.post("/add-roi", JSON.stringify(roi), function (roi) {
+    $.post("/add-rois", JSON.stringify({'scan_id': scan_md.uid, 'rois': [roi]}), function (data) {
 
-        drawROI(enabledElement, roi['x'], roi['y'], roi['w'], roi['h'], roi['color']);
-        refresh_roi_groups(scan_md.uid);
+        for (var i = 0; i < data.rois.length; i++) {
+            var added = data.rois[i];
+            cacheROI(added);
+            if (added['slice'] === stack.currentImageIdIndex) {
+                drawROI(enabledElement, added['x'], added['y'], added['w'], added['h'], added['color']);
+            }
+        }
+        render_roi_groups(data.groups);
     });
 
 });
@@ -80,7 +85,7 @@ $('#dicomImage').on("CornerstoneImageRendered", function (e, eventData) {
 
     var enabledElement = cornerstone.getEnabledElement(eventData.element);
 
-    $.get("/get-rois/" + scan_md.uid + "/" + stack.currentImageIdIndex, function (data) {
+    withSliceRois(stack.currentImageIdIndex, function (data) {
 
         for (var i = 0; i < data.length; i++) {
             var roi = data[i];
@@ -107,6 +112,7 @@ $('#erase').click(function () {
         $.post("/delete-roi", JSON.stringify(to_delete), function (data) {
 
             // re renders the image
+            invalidateROIs();
             cornerstone.enable(element);
 
             refresh_roi_groups(scan_md.uid);
@@ -124,24 +130,56 @@ $('#save').click(function () {
 });
 
 refresh_roi_groups = function (scan_id) {
-    $.get("/get-roi-groups/" + scan_id, function (data) {
-        var roi_groups = data;
+    $.get("/get-roi-groups/" + scan_id, render_roi_groups);
+}
 
+render_roi_groups = function (roi_groups) {
 
-        $("#roiTable tbody").html("");
+    $("#roiTable tbody").html("");
 
-        for (var i = 0; i < roi_groups.length; i++) {
-            var roi = roi_groups[i];
+    for (var i = 0; i < roi_groups.length; i++) {
+        var roi = roi_groups[i];
 
-            var color = roi["color"];
-            var roi_row = '<tr style="cursor:pointer"><td id="' + color + '" bgcolor="' + color + '">'
-                + roi["label"] + ' ' + roi["min_slice"] + ':' + roi["max_slice"] + '</td></tr>';
-            $("#roiTable tbody").append(roi_row);
+        var color = roi["color"];
+        var roi_row = '<tr style="cursor:pointer"><td id="' + color + '" bgcolor="' + color + '">'
+            + roi["label"] + ' ' + roi["min_slice"] + ':' + roi["max_slice"] + '</td></tr>';
+        $("#roiTable tbody").append(roi_row);
 
-        }
+    }
+}
+
+// ROIs of a window of slices around the current one, fetched in a single request
+var roiWindowSize = 32;
+var roiWindow = null;
+var roisBySlice = {};
+
+function withSliceRois(slice, callback) {
+    if (roiWindow !== null && slice >= roiWindow[0] && slice < roiWindow[1]) {
+        callback(roisBySlice[slice] || []);
+        return;
+    }
+
+    var start = Math.max(0, slice - roiWindowSize / 2);
+    var stop = start + roiWindowSize;
+    $.get("/get-rois/" + scan_md.uid + "?start=" + start + "&stop=" + stop, function (data) {
+        roisBySlice = data;
+        roiWindow = [start, stop];
+        callback(roisBySlice[slice] || []);
     });
 }
 
+function cacheROI(roi) {
+    var slice = roi['slice'];
+    if (roiWindow !== null && slice >= roiWindow[0] && slice < roiWindow[1]) {
+        roisBySlice[slice] = (roisBySlice[slice] || []).concat([roi]);
+    }
+}
+
+function invalidateROIs() {
+    roiWindow = null;
+    roisBySlice = {};
+}
+
 function hexToRGB(hex, alpha) {
     var r = parseInt(hex.slice(1, 3), 16),
         g = parseInt(hex.slice(3, 5), 16),
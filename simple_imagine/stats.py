@@ -0,0 +1,157 @@
+""" HU statistics of scan volumes.
+
+    One pass over the volume, a slab at a time, gathers the exact min, max and sum of every slice and a
+    histogram of every slice in HU. Percentiles of the slices and of the volume, and the suggested windows,
+    are all derived from those histograms. The pass results are stored next to the compressed volume as
+    <hash>.stats.npz, along with the mtime and size of the .mat they were computed from. Stored results
+    whose slice count differs from the served volume are computed again """
+import os
+import numpy as np
+import common
+import files
+import storage
+
+# Histogram bins in HU. Values outside the range are counted in the first or last bin
+bin_start = -1024
+bin_width = 4
+num_bins = 1024
+percentiles = (0.5, 1, 5, 25, 50, 75, 95, 99, 99.5)
+# HU range of the voxels that the tissue window is computed from, which leaves out air and bone
+tissue_range = (-100, 200)
+
+
+def _bin_lut(dtype, slope, intercept):
+    """ Histogram bin of every value of a 16-bit dtype, indexed through its uint16 view """
+    stored_values = np.arange(2 ** 16, dtype=np.uint16).view(dtype)
+    return _bins(stored_values, slope, intercept).astype(np.uint16)
+
+
+def _bins(values, slope, intercept):
+    hu = values * np.float64(slope) + np.float64(intercept)
+    return np.clip(np.floor((hu - bin_start) / bin_width), 0, num_bins - 1).astype(np.int64)
+
+
+def compute(volume, slope=1.0, intercept=0.0, slab=16):
+    """ Returns the per slice min, max, sum and histogram of a (slices, rows, columns) volume, in HU """
+    num_slices = len(volume)
+    slice_voxels = int(np.prod(volume.shape[1:]))
+    slice_min = np.empty(num_slices)
+    slice_max = np.empty(num_slices)
+    slice_sum = np.empty(num_slices)
+    histograms = np.empty((num_slices, num_bins), dtype=np.int64)
+    lut = _bin_lut(volume.dtype, slope, intercept) if volume.dtype.itemsize == 2 and volume.dtype.kind in 'iu' \
+        else None
+
+    for start in range(0, num_slices, slab):
+        values = np.asarray(volume[start:start + slab])
+        values = values.reshape(len(values), -1)
+        slice_min[start:start + len(values)] = values.min(axis=1)
+        slice_max[start:start + len(values)] = values.max(axis=1)
+        slice_sum[start:start + len(values)] = values.sum(axis=1, dtype=np.float64)
+
+        bins = lut[values.view(np.uint16)] if lut is not None else _bins(values, slope, intercept)
+        # Offset the bins of every slice, so a single bincount histograms the whole slab
+        bins = bins + (np.arange(len(values)) * num_bins)[:, np.newaxis]
+        histograms[start:start + len(values)] = np.bincount(bins.ravel(), minlength=len(values) * num_bins) \
+            .reshape(len(values), num_bins)
+
+    # Rescale the stored extremes to HU - a negative slope swaps them
+    low = slice_min * slope + intercept
+    high = slice_max * slope + intercept
+    return {'slice_min': np.minimum(low, high), 'slice_max': np.maximum(low, high),
+            'slice_sum': slice_sum * slope + intercept * slice_voxels,
+            'slice_voxels': np.full(num_slices, slice_voxels, dtype=np.int64),
+            'histograms': histograms}
+
+
+def histogram_percentiles(histograms, qs=percentiles):
+    """ Percentiles in HU of histograms (..., num_bins), interpolated within their bin """
+    cumulative = np.cumsum(histograms, axis=-1)
+    targets = cumulative[..., -1:] * (np.asarray(qs, dtype=np.float64) / 100.0)
+    idx = np.minimum((cumulative[..., np.newaxis, :] < targets[..., np.newaxis]).sum(axis=-1), num_bins - 1)
+    before = np.where(idx > 0, np.take_along_axis(cumulative, np.maximum(idx - 1, 0), axis=-1), 0)
+    counts = np.take_along_axis(histograms, idx, axis=-1)
+    fraction = np.clip((targets - before) / np.maximum(counts, 1), 0, 1)
+    return bin_start + (idx + fraction) * bin_width
+
+
+def _window(low, high):
+    return [float((low + high) / 2.0), float(max(high - low, 1.0))]
+
+
+def summarize(computed, slope=1.0, intercept=0.0, default_window=None):
+    """ JSON friendly statistics and suggested (center, width) windows of the pass results of compute """
+    slice_min, slice_max = computed['slice_min'], computed['slice_max']
+    histograms = computed['histograms']
+    volume_histogram = histograms.sum(axis=0)
+    volume_min = float(slice_min.min()) if len(slice_min) else 0.0
+    volume_max = float(slice_max.max()) if len(slice_max) else 0.0
+
+    slice_percentiles = np.clip(histogram_percentiles(histograms), slice_min[:, np.newaxis],
+                                slice_max[:, np.newaxis])
+    volume_percentiles = np.clip(histogram_percentiles(volume_histogram), volume_min, volume_max)
+
+    tissue_bins = (np.arange(num_bins) * bin_width + bin_start >= tissue_range[0]) & \
+                  (np.arange(num_bins) * bin_width + bin_start < tissue_range[1])
+    tissue = histogram_percentiles(np.where(tissue_bins, volume_histogram, 0), (5, 95))
+
+    windows = {'full': _window(volume_percentiles[percentiles.index(0.5)],
+                               volume_percentiles[percentiles.index(99.5)])}
+    if volume_histogram[tissue_bins].any():
+        windows['tissue'] = _window(*tissue)
+    if default_window is not None:
+        windows['default'] = [float(v) for v in default_window]
+
+    return {
+        'rescale': [float(slope), float(intercept)],
+        'bins': {'start': bin_start, 'width': bin_width, 'count': num_bins},
+        'volume': {'min': volume_min, 'max': volume_max,
+                   'mean': float(computed['slice_sum'].sum() / max(computed['slice_voxels'].sum(), 1)),
+                   'percentiles': {str(q): float(v) for q, v in zip(percentiles, volume_percentiles)},
+                   'histogram': volume_histogram.tolist()},
+        'slices': {'min': slice_min.tolist(), 'max': slice_max.tolist(),
+                   'mean': (computed['slice_sum'] / np.maximum(computed['slice_voxels'], 1)).tolist(),
+                   'percentiles': {str(q): slice_percentiles[:, i].tolist() for i, q in enumerate(percentiles)}},
+        'windows': windows,
+    }
+
+
+def stats_path(uid, compressed_volumes_dir=None):
+    if compressed_volumes_dir is None:
+        compressed_volumes_dir = storage.default.volume_folder(uid)
+    return os.path.join(compressed_volumes_dir, common.string2hash(uid) + '.stats.npz')
+
+
+def _source(scan):
+    stat = os.stat(scan.path)
+    return '%x-%x' % (stat.st_mtime_ns, stat.st_size)
+
+
+def load(scan):
+    """ Returns the stored pass results of a scan, or None if there are none for its current .mat and
+        served volume """
+    path = stats_path(scan.uid, scan.compressed_volume_directory)
+    try:
+        with np.load(path) as stored:
+            if str(stored['source']) != _source(scan) or len(stored['slice_min']) != scan.stored_shape()[0]:
+                return None
+            return {name: stored[name] for name in stored.files if name != 'source'}
+    except (IOError, KeyError, ValueError):
+        return None
+
+
+def store(scan, computed):
+    path = stats_path(scan.uid, scan.compressed_volume_directory)
+    with files.replacing(path) as tmp_path, open(tmp_path, 'wb') as f:
+        np.savez(f, source=np.array(_source(scan)), **computed)
+
+
+def scan_stats(scan, volume=None):
+    """ Returns the pass results of a scan, computing and storing them unless they are stored already.
+        volume defaults to the volume served for the scan """
+    computed = load(scan)
+    if computed is None:
+        slope, intercept = scan.rescale()
+        computed = compute(volume if volume is not None else scan.read_slices(), slope, intercept)
+        store(scan, computed)
+    return computed
@@ -0,0 +1,258 @@
+""" Storage of the scan files: the roots they live in, and the backends that hold them.
+
+    The .mat scans live in the archive root, and their compressed volumes in the volume root, which is the
+    archive root unless configured otherwise. An optional SSD root is a cache tier in front of the archive:
+    once a scan was viewed promote_after times in a process, all its files are copied to the SSD root in
+    the background, and its paths resolve there for as long as the copy has the mtime and size of the
+    archived .mat. The SSD tier is bounded by ssd_max_bytes, evicting the least recently used scans.
+
+    Roots are given as paths or as URLs whose scheme selects a backend, 'file' being the only backend so
+    far. Backends hand out local paths - a remote backend would mount or stage its files - so that the HDF5
+    handle pool of hdf5_pool keeps them open between requests.
+
+    Scans are listed by a scan of the archive directory. The uid of a file, which is named by the hash of
+    the uid, is looked up in the known uids, or read from the uid field of the file """
+import os
+import glob
+import time
+import shutil
+import logging
+import threading
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+import h5py
+import common
+import files
+from cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+
+class LocalBackend:
+    """ Files in a local directory """
+
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, name):
+        return os.path.join(self.root, name)
+
+    def stat(self, name):
+        """ Returns the os.stat_result of a file, or None if there is none """
+        try:
+            return os.stat(self.path(name))
+        except OSError:
+            return None
+
+    def list(self, suffix=''):
+        """ Returns (name, stat) of the files whose name ends with suffix """
+        if not os.path.isdir(self.root):
+            return []
+        return [(entry.name, entry.stat()) for entry in os.scandir(self.root)
+                if entry.name.endswith(suffix) and entry.is_file()]
+
+    def glob(self, pattern):
+        return [os.path.basename(path) for path in glob.glob(os.path.join(glob.escape(self.root), pattern))]
+
+    def copy_from(self, source, name):
+        """ Copies a file of another backend, keeping its mtime. Readers never see a partial copy """
+        os.makedirs(self.root, exist_ok=True)
+        with files.replacing(self.path(name)) as tmp_path:
+            shutil.copy2(source.path(name), tmp_path)
+
+    def remove(self, name):
+        files.remove(self.path(name))
+
+    def touch(self, name):
+        with open(self.path(name), 'a'):
+            os.utime(self.path(name))
+
+    def __repr__(self):
+        return 'LocalBackend(%r)' % self.root
+
+
+# URL scheme: backend class, whose constructor takes the path of the URL
+backends = {'file': LocalBackend}
+
+
+def register_backend(scheme, backend_class):
+    backends[scheme] = backend_class
+
+
+def open_backend(root):
+    """ Returns the backend of a root, given as a path or as a URL """
+    if isinstance(root, tuple(backends.values())):
+        return root
+    parsed = urllib.parse.urlsplit(root)
+    if len(parsed.scheme) <= 1:
+        # A plain path, or a Windows drive letter
+        return LocalBackend(root)
+    if parsed.scheme not in backends:
+        raise ValueError('Unknown storage backend: %s' % parsed.scheme)
+    return backends[parsed.scheme](urllib.parse.unquote(parsed.netloc + parsed.path))
+
+
+class Storage:
+    """ Roots of the scan files. A root of None is the CTscans folder of the data root, which is looked up
+        on every use, so it follows changes of common.res_strings """
+
+    # Marker files of promoted scans are touched on access at most this often, to keep their mtime usable
+    # for LRU eviction
+    touch_interval = 60
+    promoted_suffix = '.promoted'
+
+    def __init__(self, archive=None, ssd=None, volumes=None, ssd_max_bytes=200 * 1024 ** 3, promote_after=3):
+        self._archive = open_backend(archive) if archive is not None else None
+        self.ssd = open_backend(ssd) if ssd is not None else None
+        self.volumes = open_backend(volumes) if volumes is not None else None
+        self.ssd_max_bytes = ssd_max_bytes
+        self.promote_after = promote_after
+        self._accesses = LRUCache(4096, sizeof=lambda item: 1)
+        self._touched = LRUCache(4096, sizeof=lambda item: 1)
+        self._file_uids = LRUCache(65536, sizeof=lambda item: 1)
+        self._promoting = set()
+        self._lock = threading.Lock()
+        self._executor = None
+        self._executor_pid = None
+
+    @property
+    def archive(self):
+        return self._archive or LocalBackend(common.getTMpath('CTscans'))
+
+    def scan_folder(self, uid):
+        """ Folder of the .mat of a scan - in the SSD tier when it holds a current copy """
+        if self.ssd is not None:
+            name = common.string2hash(uid) + '.mat'
+            copy = self.ssd.stat(name)
+            if copy is not None:
+                original = self.archive.stat(name)
+                if original is not None and (copy.st_mtime_ns, copy.st_size) == (original.st_mtime_ns,
+                                                                                  original.st_size):
+                    self._touch_promoted(common.string2hash(uid))
+                    return self.ssd.root
+        return self.archive.root
+
+    def volume_folder(self, uid, scanfolder=None):
+        """ Folder of the compressed volumes of a scan, by default the folder of its .mat """
+        if self.volumes is not None:
+            return self.volumes.root
+        return scanfolder or self.scan_folder(uid)
+
+    def record_access(self, uid):
+        """ Counts a view of a scan, and promotes it to the SSD tier once it was viewed promote_after times """
+        if self.ssd is None:
+            return
+        with self._lock:
+            count = (self._accesses.get(uid) or 0) + 1
+            self._accesses.put(uid, count)
+            if count < self.promote_after or uid in self._promoting:
+                return
+            if self.ssd.stat(common.string2hash(uid) + '.mat') is not None and \
+                    self.scan_folder(uid) == self.ssd.root:
+                return
+            self._promoting.add(uid)
+            if self._executor is None or self._executor_pid != os.getpid():
+                # Threads do not survive a fork, so every worker process starts its own
+                self._executor = ThreadPoolExecutor(1, thread_name_prefix='promote')
+                self._executor_pid = os.getpid()
+        self._executor.submit(self._promote_in_background, uid)
+
+    def _promote_in_background(self, uid):
+        try:
+            self.promote(uid)
+        except Exception:
+            logger.exception('uid %s: Error promoting scan to the SSD tier', uid)
+        finally:
+            with self._lock:
+                self._promoting.discard(uid)
+
+    def promote(self, uid):
+        """ Copies all files of a scan to the SSD tier, the .mat last, so its paths only resolve there once
+            all files are copied """
+        scan_hash = common.string2hash(uid)
+        names = [name for name in self.archive.glob(scan_hash + '.*')
+                 if not name.endswith('.tmp') and name != scan_hash + '.mat']
+        for name in names + [scan_hash + '.mat']:
+            self.ssd.copy_from(self.archive, name)
+        self.ssd.touch(scan_hash + self.promoted_suffix)
+        self.evict()
+
+    def _touch_promoted(self, scan_hash):
+        now = time.time()
+        last = self._touched.get(scan_hash)
+        if last is None or now - last >= self.touch_interval:
+            self._touched.put(scan_hash, now)
+            try:
+                self.ssd.touch(scan_hash + self.promoted_suffix)
+            except OSError:
+                pass
+
+    def evict(self):
+        """ Removes the least recently used scans of the SSD tier until it fits in ssd_max_bytes """
+        sizes = {}
+        for name, stat in self.ssd.list():
+            sizes.setdefault(name.split('.', 1)[0], 0)
+            sizes[name.split('.', 1)[0]] += stat.st_size
+        used = [(stat.st_mtime, name[:-len(self.promoted_suffix)])
+                for name, stat in self.ssd.list(self.promoted_suffix)]
+        total_bytes = sum(sizes.values())
+        for _, scan_hash in sorted(used):
+            if total_bytes <= self.ssd_max_bytes:
+                break
+            # The .mat goes first, so the scan resolves to the archive before its other files disappear
+            names = sorted(self.ssd.glob(scan_hash + '.*'), key=lambda name: name != scan_hash + '.mat')
+            for name in names:
+                self.ssd.remove(name)
+            total_bytes -= sizes.get(scan_hash, 0)
+
+    def list_scans(self, scanfolder=None, known_uids=()):
+        """ Returns {hash: uid} of the .mat scans of the archive, or of scanfolder. Files whose uid is
+            neither in known_uids nor stored in the file are left out """
+        return {scan_hash: uid for scan_hash, (uid, _) in self.list_scan_files(scanfolder, known_uids).items()}
+
+    def list_scan_files(self, scanfolder=None, known_uids=(), read_uids=True):
+        """ Returns {hash: (uid, os.stat_result)} of the .mat scans of the archive, or of scanfolder. Files
+            whose uid is not in known_uids are read for their uid, or left out without read_uids """
+        backend = open_backend(scanfolder) if scanfolder else self.archive
+        uid_by_hash = {common.string2hash(uid): uid for uid in known_uids}
+        scans = {}
+        for name, stat in backend.list('.mat'):
+            scan_hash = name[:-len('.mat')]
+            uid = uid_by_hash.get(scan_hash)
+            if uid is None and read_uids:
+                uid = self._file_uid(backend.path(name), stat)
+            if uid is not None:
+                scans[scan_hash] = (uid, stat)
+        return scans
+
+    def scan_uids(self, scanfolder=None, known_uids=()):
+        """ Returns the sorted uids of the .mat scans of the archive, or of scanfolder """
+        return sorted(self.list_scans(scanfolder, known_uids).values())
+
+    def _file_uid(self, path, stat):
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        cached = self._file_uids.get(path)
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+        uid = None
+        try:
+            with h5py.File(path, 'r', locking=False) as raw_scan:
+                if 'uid' in raw_scan:
+                    uid = raw_scan['uid'][()].tobytes().decode('utf-16')
+        except (OSError, KeyError, ValueError):
+            logger.warning('Unable to read the uid of %s', path)
+        if uid is not None and common.string2hash(uid) != os.path.basename(path)[:-len('.mat')]:
+            logger.warning('The uid of %s does not match its file name', path)
+            uid = None
+        self._file_uids.put(path, (stamp, uid))
+        return uid
+
+
+default = Storage()
+
+
+def configure(archive=None, ssd=None, volumes=None, ssd_max_bytes=200 * 1024 ** 3, promote_after=3):
+    """ Replaces the storage that scans are looked up in by default """
+    global default
+    default = Storage(archive, ssd, volumes, ssd_max_bytes, promote_after)
+    return default
@@ -0,0 +1,151 @@
+""" Synthetic MATLAB v7.3 (HDF5) scans with the layout Scan.fromID expects.
+
+    Usage: python -m synthetic OUTPUT_DIR [--count N] [--slices N] [--size N] [--type hemo|cspine]
+
+    Scans are written as <string2hash(uid)>.mat and their uids are printed """
+import os
+import argparse
+import numpy as np
+import h5py
+import common
+
+
+def _char(text):
+    # MATLAB stores char arrays as UTF-16 code units, one per row
+    return np.frombuffer(text.encode('utf-16-le'), dtype=np.uint16).reshape(-1, 1)
+
+
+def _scalar(value):
+    return np.array([[value]], dtype=np.float64)
+
+
+class _Writer:
+
+    def __init__(self, f):
+        self.f = f
+        self.refs = f.create_group('#refs#')
+        self._num_refs = 0
+
+    def char(self, group, key, text):
+        dataset = group.create_dataset(key, data=_char(text))
+        dataset.attrs['MATLAB_class'] = np.bytes_('char')
+        return dataset
+
+    def double(self, group, key, value):
+        dataset = group.create_dataset(key, data=np.asarray(value, dtype=np.float64))
+        dataset.attrs['MATLAB_class'] = np.bytes_('double')
+        return dataset
+
+    def _ref(self, data, matlab_class):
+        name = 'r%d' % self._num_refs
+        self._num_refs += 1
+        dataset = self.refs.create_dataset(name, data=data)
+        dataset.attrs['MATLAB_class'] = np.bytes_(matlab_class)
+        return dataset.ref
+
+    def cell(self, group, key, values, matlab_class='char'):
+        """ Writes a cell array. values are strings for cells of char, or arrays for cells of double """
+        if len(values) == 0:
+            # MATLAB writes an empty cell array as its dimensions, flagged with MATLAB_empty
+            dataset = group.create_dataset(key, data=np.zeros(2, dtype=np.uint64))
+            dataset.attrs['MATLAB_empty'] = np.uint8(1)
+        else:
+            refs = [[self._ref(_char(value) if matlab_class == 'char' else np.asarray(value, dtype=np.float64),
+                               matlab_class)] for value in values]
+            dataset = group.create_dataset(key, data=np.array(refs, dtype=h5py.ref_dtype))
+        dataset.attrs['MATLAB_class'] = np.bytes_('cell')
+        return dataset
+
+
+def synthetic_volume(slices, rows, columns, seed=0):
+    """ Stored (HU + 1024) int16 volume of a head-like phantom: air, a skull ring and noisy brain tissue.
+        The volume is laid out as in the .mat files, (slices, columns, rows) """
+    rng = np.random.RandomState(seed)
+    y, x = np.ogrid[-1:1:rows * 1j, -1:1:columns * 1j]
+    radius = np.sqrt(x ** 2 + y ** 2)
+
+    volume = np.empty((slices, columns, rows), dtype=np.int16)
+    for idx in range(slices):
+        # The head gets smaller towards the top slices
+        scale = 0.9 - 0.3 * idx / max(slices - 1, 1)
+        hu = np.full((rows, columns), -1000, dtype=np.float32)
+        hu[radius < scale] = 1000
+        brain = radius < scale - 0.06
+        hu[brain] = 35 + rng.normal(0, 8, size=int(brain.sum()))
+        volume[idx] = (hu + 1024).astype(np.int16).T
+    return volume
+
+
+def write_scan(path, slices=150, rows=512, columns=512, uid='', scan_type='hemo', plane='ax',
+               simulated_short=False, all_metadata=True, slice_spacing=5.0, pixel_spacing=0.45, seed=0):
+    """ Writes a synthetic scan to path """
+    with h5py.File(path, 'w') as f:
+        writer = _Writer(f)
+        f.create_dataset('volume', data=synthetic_volume(slices, rows, columns, seed))
+        writer.double(f, 'size', [[rows], [columns], [slices]])
+        writer.char(f, 'name', 'Synthetic ' + (uid or str(seed)))
+        if uid:
+            # Lets the scan be listed by a scan of its folder, without a list of known uids
+            writer.char(f, 'uid', uid)
+        # Window as (center, width) in HU, shifted to stored values by matlabWindowShift
+        writer.double(f, 'defWindow', [[40.0], [80.0]])
+        writer.double(f, 'matlabWindowShift', [[1024.0], [0.0]])
+
+        metadata = f.create_group('metadata')
+        writer.char(metadata, 'PhotometricInterpretation', 'MONOCHROME2')
+        writer.char(metadata, 'AccessionNumber', 'SYN%06d' % seed)
+        writer.char(metadata, 'StudyInstanceUID', '1.2.826.0.1.%d' % seed)
+        writer.char(metadata, 'FrameOfReferenceUID', '1.2.826.0.2.%d' % seed)
+        writer.double(metadata, 'RescaleSlope', _scalar(1.0))
+        writer.double(metadata, 'RescaleIntercept', _scalar(-1024.0))
+        writer.double(metadata, 'PixelSpacing', [[pixel_spacing, pixel_spacing]])
+        writer.double(metadata, 'SliceThickness', _scalar(slice_spacing))
+        writer.double(metadata, 'SpacingBetweenSlices', _scalar(slice_spacing))
+        writer.double(metadata, 'ImageOrientationPatient', [[1.0, 0.0, 0.0, 0.0, 1.0, 0.0]])
+        writer.double(metadata, 'ImagePositionPatient', [[-115.0, -115.0, 0.0]])
+
+        extra_data = f.create_group('extraData')
+        writer.cell(extra_data, 'type', [scan_type])
+        writer.char(extra_data, 'plane', plane)
+        writer.char(extra_data, 'AN', 'SYN%06d' % seed)
+        writer.cell(extra_data, 'specialmarks', [] if simulated_short else ['short'])
+
+        if all_metadata:
+            group = f.create_group('all_metadata')
+            positions = [[[-115.0, -115.0, idx * slice_spacing]] for idx in range(slices)]
+            writer.cell(group, 'ImagePositionPatient', positions, matlab_class='double')
+        else:
+            dataset = f.create_dataset('all_metadata', data=np.zeros(2, dtype=np.uint64))
+            dataset.attrs['MATLAB_empty'] = np.uint8(1)
+    return path
+
+
+def write_scans(folder, count=1, prefix='synthetic', **kwargs):
+    """ Writes count synthetic scans into folder and returns their uids """
+    scan_uids = []
+    for idx in range(count):
+        uid = '%s.%d' % (prefix, idx)
+        write_scan(os.path.join(folder, common.string2hash(uid) + '.mat'), uid=uid, seed=idx, **kwargs)
+        scan_uids.append(uid)
+    return scan_uids
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Write synthetic MATLAB v7.3 scans')
+    parser.add_argument('folder')
+    parser.add_argument('--count', type=int, default=1)
+    parser.add_argument('--slices', type=int, default=150)
+    parser.add_argument('--size', type=int, default=512, help='rows and columns of every slice')
+    parser.add_argument('--type', default='hemo', choices=['hemo', 'cspine'])
+    parser.add_argument('--plane', default='ax')
+    parser.add_argument('--prefix', default='synthetic')
+    args = parser.parse_args()
+
+    os.makedirs(args.folder, exist_ok=True)
+    for uid in write_scans(args.folder, args.count, prefix=args.prefix, slices=args.slices, rows=args.size,
+                           columns=args.size, scan_type=args.type, plane=args.plane):
+        print(uid)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+""" Local disk cache of decoded volumes, shared by all worker processes.
+
+    Volumes are stored transposed and ready to serve as .npy files and are opened with mmap_mode='r', so the
+    page cache holds a single copy of a hot scan for every worker. Entries are keyed by the scan validator,
+    so a changed scan never hits a stale entry, and the cache is bounded by total bytes with LRU eviction """
+import os
+import glob
+import time
+import fcntl
+import logging
+import numpy as np
+import common
+import files
+from scan import scan_validator
+
+logger = logging.getLogger(__name__)
+
+
+class VolumeCache:
+
+    # Entries are touched on access at most this often, to keep their mtime usable for LRU eviction
+    touch_interval = 60
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def _entry_path(self, scan):
+        validator, _ = scan_validator(scan.uid, scan.directory, scan.compressed_volume_directory)
+        return os.path.join(self.directory, '%s-%s.npy' % (common.string2hash(scan.uid),
+                                                           common.string2hash(validator)))
+
+    def _open(self, path):
+        try:
+            volume = np.load(path, mmap_mode='r')
+        except (IOError, OSError, ValueError):
+            return None
+
+        try:
+            if time.time() - os.path.getmtime(path) > self.touch_interval:
+                os.utime(path)
+        except OSError:
+            pass
+        return volume
+
+    def get(self, scan):
+        """ Returns the cached volume of a scan as a read only memory map, or None """
+        return self._open(self._entry_path(scan))
+
+    def get_or_load(self, scan):
+        """ Returns the cached volume of a scan, decoding and storing it first if needed. Concurrent
+            loads of the same scan, in any process, wait for a single decode """
+        path = self._entry_path(scan)
+        volume = self._open(path)
+        if volume is not None:
+            return volume
+
+        scan_hash = common.string2hash(scan.uid)
+        with open(os.path.join(self.directory, scan_hash + '.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                volume = self._open(path)
+                if volume is None:
+                    self._fill(scan, path)
+                    volume = self._open(path)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+        # Entries of older versions of the scan
+        for stale_path in glob.glob(os.path.join(self.directory, scan_hash + '-*.npy')):
+            if stale_path != path:
+                files.remove(stale_path)
+
+        self.evict()
+        return volume
+
+    def _fill(self, scan, path):
+        shape = scan.stored_shape()
+        with files.replacing(path) as tmp_path:
+            # The volume is written one slice at a time, so it is never held in memory as a whole
+            volume = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=scan.dtype, shape=tuple(shape))
+            for idx, slice_data in enumerate(scan._iter_slice_arrays(0, None)):
+                volume[idx] = slice_data
+            volume.flush()
+            del volume
+
+    def entries(self):
+        """ Returns (mtime, size, path) of all entries, least recently used first """
+        entries = []
+        for path in glob.glob(os.path.join(self.directory, '*.npy')):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        return sorted(entries)
+
+    def evict(self):
+        entries = self.entries()
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total_bytes <= self.max_bytes:
+                break
+            # Workers that have the entry mapped keep reading it until they unmap it
+            files.remove(path)
+            total_bytes -= size
@@ -0,0 +1,103 @@
+""" Compression codecs of stored volumes.
+
+    A codec is given by a spec string name[+filter ...][:level], such as 'gzip:9', 'lzma' or
+    'zlib+delta+shuffle:6'. Filters transform the array before it is compressed:
+        delta   - every slice but the first is replaced by its difference to the previous slice
+        shuffle - the bytes of the values are grouped by significance, so the mostly constant high bytes of
+                  16-bit CT values end up in long runs
+    Stored volumes record the spec of their codec, so readers decode them without any configuration """
+import gzip
+import lzma
+import zlib
+import numpy as np
+
+# name: (compress(data, level), decompress(data), default level)
+compressors = {
+    'gzip': (lambda data, level: gzip.compress(data, level, mtime=0), gzip.decompress, 9),
+    'zlib': (zlib.compress, zlib.decompress, 6),
+    'lzma': (lambda data, level: lzma.compress(data, preset=level), lzma.decompress, 6),
+}
+# Encoding applies the filters in this order, decoding in reverse
+filter_names = ('delta', 'shuffle')
+
+
+class Codec:
+
+    def __init__(self, name='zlib', filters=(), level=None):
+        if name not in compressors:
+            raise ValueError('Unknown codec: %s' % name)
+        unknown = set(filters) - set(filter_names)
+        if unknown:
+            raise ValueError('Unknown filter: %s' % ', '.join(sorted(unknown)))
+        self.name = name
+        self.filters = tuple(f for f in filter_names if f in filters)
+        self.level = compressors[name][2] if level is None else int(level)
+        if not 0 <= self.level <= 9:
+            raise ValueError('Invalid level %d of codec %s' % (self.level, name))
+
+    @property
+    def spec(self):
+        return '%s:%d' % ('+'.join((self.name,) + self.filters), self.level)
+
+    def encode(self, array):
+        """ Compresses an array of shape (slices, ...) """
+        array = np.ascontiguousarray(array)
+        if 'delta' in self.filters:
+            array = _delta_encode(array)
+        data = _shuffle(array) if 'shuffle' in self.filters else array.tobytes()
+        return compressors[self.name][0](data, self.level)
+
+    def decode(self, data, dtype, shape):
+        """ Inflates data encoded by encode into an array of the given dtype and shape """
+        dtype = np.dtype(dtype)
+        data = compressors[self.name][1](data)
+        array = _unshuffle(data, dtype) if 'shuffle' in self.filters else np.frombuffer(data, dtype=dtype)
+        array = array.reshape(shape)
+        if 'delta' in self.filters:
+            array = _delta_decode(array)
+        return array
+
+    def __repr__(self):
+        return 'Codec(%r)' % self.spec
+
+
+def get_codec(spec=None, level=None):
+    """ Returns the codec of a spec string. level is used when the spec does not give one """
+    if isinstance(spec, Codec):
+        return spec
+    names, _, spec_level = (spec or 'zlib').partition(':')
+    names = names.split('+')
+    return Codec(names[0], names[1:], int(spec_level) if spec_level else level)
+
+
+def _unsigned(dtype):
+    # Differences are taken on the unsigned view of the values, so they wrap around and are always exact
+    if dtype.itemsize not in (1, 2, 4, 8):
+        raise ValueError('Delta filter does not support dtype %s' % dtype)
+    return np.dtype('u%d' % dtype.itemsize)
+
+
+def _delta_encode(array):
+    if array.ndim == 0 or len(array) < 2:
+        return array
+    values = array.view(_unsigned(array.dtype))
+    deltas = np.empty_like(values)
+    deltas[0] = values[0]
+    np.subtract(values[1:], values[:-1], out=deltas[1:])
+    return deltas.view(array.dtype)
+
+
+def _delta_decode(array):
+    if array.ndim == 0 or len(array) < 2:
+        return array
+    values = array.view(_unsigned(array.dtype))
+    return np.cumsum(values, axis=0, dtype=values.dtype).view(array.dtype)
+
+
+def _shuffle(array):
+    return np.ascontiguousarray(array.view(np.uint8).reshape(-1, array.dtype.itemsize).T).tobytes()
+
+
+def _unshuffle(data, dtype):
+    planes = np.frombuffer(data, dtype=np.uint8).reshape(dtype.itemsize, -1)
+    return np.ascontiguousarray(planes.T).view(dtype).ravel()
@@ -0,0 +1,188 @@
+""" Random-access container for scan volumes.
+
+    Layout of a .vol file:
+        magic (8 bytes) | header length (uint32) | JSON header | block offsets (uint64 * (blocks + 1)) | blocks
+
+    The header holds the volume shape, dtype, rescale slope/intercept, plane, the number of slices per
+    block (slab) and the spec of the codec of the blocks (zlib when missing). Every block is compressed on
+    its own, so any slice is read with one seek and one inflate """
+import os
+import json
+import gzip
+import struct
+import numpy as np
+import files
+import volume_codecs
+
+MAGIC = b'SIMGVOL1'
+_header_length = struct.Struct('<I')
+
+
+class VolumeWriter:
+    """ Writes a volume slab by slab. The shape must be known upfront so that the offset index can be
+        reserved right after the header """
+
+    def __init__(self, path, shape, dtype, rescale=(1.0, 0.0), plane='axial', slab=1, compresslevel=6,
+                 codec=None, source=None):
+        self.path = path
+        self.shape = tuple(int(s) for s in shape)
+        self.dtype = np.dtype(dtype)
+        self.slab = int(slab)
+        self.codec = volume_codecs.get_codec(codec, level=compresslevel)
+        self.num_blocks = -(-self.shape[0] // self.slab)
+        self.offsets = [0] * (self.num_blocks + 1)
+        self._pending = []
+        self._block = 0
+
+        header = json.dumps({'shape': self.shape, 'dtype': self.dtype.str, 'rescale': list(rescale),
+                             'plane': plane, 'slab': self.slab, 'codec': self.codec.spec,
+                             'source': source}).encode('utf-8')
+
+        # Renamed over path on close
+        self._tmp_path = files.temp_path(path)
+        self._file = open(self._tmp_path, 'wb')
+        self._file.write(MAGIC)
+        self._file.write(_header_length.pack(len(header)))
+        self._file.write(header)
+        self._index_offset = self._file.tell()
+        self._file.write(np.zeros(self.num_blocks + 1, dtype='<u8').tobytes())
+
+    def write_slices(self, slices):
+        """ Appends one slice (2D) or a stack of slices (3D) """
+        slices = np.asarray(slices, dtype=self.dtype)
+        if slices.ndim == 2:
+            slices = slices[np.newaxis]
+        for slice_data in slices:
+            self._pending.append(slice_data)
+            if len(self._pending) == self.slab:
+                self._flush_block()
+
+    def _flush_block(self):
+        if self._block >= self.num_blocks:
+            raise ValueError('More slices written than the volume shape allows')
+        block = np.ascontiguousarray(np.stack(self._pending))
+        self.offsets[self._block] = self._file.tell()
+        self._file.write(self.codec.encode(block))
+        self._block += 1
+        self._pending = []
+
+    def close(self):
+        if self._pending:
+            self._flush_block()
+        if self._block != self.num_blocks:
+            self.abort()
+            raise ValueError('Volume has %d blocks, expected %d' % (self._block, self.num_blocks))
+
+        self.offsets[self.num_blocks] = self._file.tell()
+        self._file.seek(self._index_offset)
+        self._file.write(np.array(self.offsets, dtype='<u8').tobytes())
+        self._file.close()
+        os.replace(self._tmp_path, self.path)
+
+    def abort(self):
+        self._file.close()
+        files.remove(self._tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class VolumeReader:
+    """ Reads single slices or slice ranges of a .vol file, inflating only the blocks that hold them """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        try:
+            if self._file.read(len(MAGIC)) != MAGIC:
+                raise IOError('Invalid volume file ' + path)
+            header_length, = _header_length.unpack(self._file.read(_header_length.size))
+            header = json.loads(self._file.read(header_length).decode('utf-8'))
+        except Exception:
+            self._file.close()
+            raise
+
+        self.shape = tuple(header['shape'])
+        self.dtype = np.dtype(header['dtype'])
+        self.rescale = tuple(header['rescale'])
+        self.plane = header['plane']
+        self.slab = header['slab']
+        self.codec = volume_codecs.get_codec(header.get('codec', 'zlib'))
+        # Validator of the volume this one was derived from, if it was derived from another
+        self.source = header.get('source')
+        self.num_blocks = -(-self.shape[0] // self.slab)
+        self.offsets = np.frombuffer(self._file.read(8 * (self.num_blocks + 1)), dtype='<u8')
+
+    @property
+    def num_slices(self):
+        return self.shape[0]
+
+    def _read_block(self, block):
+        start, stop = int(self.offsets[block]), int(self.offsets[block + 1])
+        self._file.seek(start)
+        return self.codec.decode(self._file.read(stop - start), self.dtype, (-1,) + self.shape[1:])
+
+    def read_slice(self, idx):
+        if not 0 <= idx < self.shape[0]:
+            raise IndexError('Slice %d out of range' % idx)
+        return self._read_block(idx // self.slab)[idx % self.slab]
+
+    def iter_slices(self, start=0, stop=None):
+        start, stop, _ = slice(start, stop).indices(self.shape[0])
+        idx = start
+        while idx < stop:
+            block = self._read_block(idx // self.slab)
+            block_start = idx - idx % self.slab
+            for slice_data in block[idx - block_start:min(stop - block_start, len(block))]:
+                yield slice_data
+                idx += 1
+
+    def read_slices(self, start=0, stop=None):
+        start, stop, _ = slice(start, stop).indices(self.shape[0])
+        volume = np.empty((max(stop - start, 0),) + self.shape[1:], dtype=self.dtype)
+        for i, slice_data in enumerate(self.iter_slices(start, stop)):
+            volume[i] = slice_data
+        return volume
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def write_volume(path, volume, rescale=(1.0, 0.0), plane='axial', slab=1, compresslevel=6, codec=None):
+    with VolumeWriter(path, volume.shape, volume.dtype, rescale=rescale, plane=plane, slab=slab,
+                      compresslevel=compresslevel, codec=codec) as writer:
+        writer.write_slices(volume)
+
+
+def convert_dat_gz(dat_gz_path, path, shape, dtype, rescale=(1.0, 0.0), plane='axial', slab=1, compresslevel=6,
+                   codec=None):
+    """ Converts a monolithic .dat.gz volume, which records neither shape nor dtype, into a .vol file.
+        The gzip stream is inflated one slice at a time, so memory stays at about one slice """
+    dtype = np.dtype(dtype)
+    slice_shape = tuple(int(s) for s in shape[1:])
+    slice_nbytes = int(np.prod(slice_shape)) * dtype.itemsize
+
+    with open(dat_gz_path, 'rb') as f:
+        # The gzip trailer holds the uncompressed size (mod 2**32)
+        f.seek(-4, os.SEEK_END)
+        nbytes, = struct.unpack('<I', f.read(4))
+    if nbytes != (int(shape[0]) * slice_nbytes) % 2 ** 32:
+        raise IOError('%s does not hold a volume of shape %s' % (dat_gz_path, str(tuple(shape))))
+
+    with VolumeWriter(path, shape, dtype, rescale=rescale, plane=plane, slab=slab, compresslevel=compresslevel,
+                      codec=codec) as writer, gzip.open(dat_gz_path, 'rb') as gz:
+        for _ in range(int(shape[0])):
+            data = gz.read(slice_nbytes)
+            writer.write_slices(np.frombuffer(data, dtype=dtype).reshape(slice_shape))
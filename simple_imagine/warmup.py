@@ -0,0 +1,233 @@
+""" Warms the caches of the worklist scans, so the first users after a deploy or restart don't pay for them.
+
+    Usage: python -m warmup [uid ...] [--folder DIR] [--limit N] [--workers N] [--read-mb-per-s MB]
+                            [--cpu-fraction F] [--compress]
+
+    The header index is brought in sync first, then the scans are warmed most recently modified first:
+    their header is parsed and their volume decoded into the volume cache, and with compress their
+    compressed volume is written when there is none. Volumes stop being decoded before they would fill the
+    volume cache, since beyond that they would only evict each other - the remaining scans only get their
+    header parsed. Reads are paced to read_mb_per_s over all workers, and every worker sleeps after each
+    scan long enough to use at most cpu_fraction of a CPU.
+
+    The app warms on start when WARMUP_ON_START is set, and reports the progress at /warmup. Every worker
+    process then warms, but the volume cache and the header index are shared, so each volume is decoded
+    once and the other workers only parse the headers """
+import os
+import time
+import logging
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import worklist_index
+from scan import Scan, compressed_volume_path, packed_volume_path
+
+logger = logging.getLogger(__name__)
+
+
+class _Pacer:
+    """ Spreads reads over time so they stay under bytes_per_s, over all threads """
+
+    def __init__(self, bytes_per_s):
+        self.bytes_per_s = bytes_per_s
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def pace(self, nbytes):
+        """ Waits until nbytes may be read """
+        if not self.bytes_per_s:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start = max(self._next, now)
+            self._next = start + nbytes / float(self.bytes_per_s)
+        if start > now:
+            time.sleep(start - now)
+
+
+class Warmer:
+    """ Warms scans on a pool of max_workers threads, in the background """
+
+    def __init__(self, volumes, max_workers=2, read_mb_per_s=None, cpu_fraction=None, compress=False):
+        self.volumes = volumes
+        self.max_workers = max_workers
+        self.cpu_fraction = cpu_fraction
+        self.compress = compress
+        self._pacer = _Pacer(read_mb_per_s * 1e6 if read_mb_per_s else None)
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._cache_filled = False
+        self._thread = None
+        self._progress = {'state': 'idle', 'total': 0, 'done': 0, 'skipped': 0, 'failed': 0, 'bytes_read': 0,
+                          'current': [], 'started': None, 'finished': None}
+
+    def start(self, app, scanfolder='', scan_uids=None, limit=None, warm_uids=None):
+        """ Starts warming in a background thread. The header index is updated in an app context """
+        self._thread = threading.Thread(target=self.run, args=(app, scanfolder, scan_uids, limit, warm_uids),
+                                        name='warmup', daemon=True)
+        self._thread.start()
+        return self._thread
+
+    def run(self, app, scanfolder='', scan_uids=None, limit=None, warm_uids=None):
+        """ Warms the scans, most recently modified first, and returns the progress once done. The header
+            index is brought in sync with the worklist scan_uids as a whole, and only the indexed scans among
+            warm_uids are warmed when given """
+        self._update(state='indexing', started=time.time())
+        try:
+            with app.app_context():
+                worklist_index.update_index(scanfolder, scan_uids)
+                query = worklist_index.ScanHeader.query.filter_by(valid=True)
+                if warm_uids is not None:
+                    query = query.filter(worklist_index.ScanHeader.uid.in_(warm_uids))
+                headers = query.order_by(worklist_index.ScanHeader.mtime.desc()).limit(limit).all()
+                ordered = [header.uid for header in headers]
+        except Exception:
+            logger.exception('Error updating the header index before warming')
+            self._update(state='failed', finished=time.time())
+            return self.progress()
+
+        self._update(state='warming', total=len(ordered))
+        with ThreadPoolExecutor(self.max_workers, thread_name_prefix='warmup') as executor:
+            for _ in executor.map(lambda uid: self._warm(uid, scanfolder), ordered):
+                pass
+        self._update(state='stopped' if self._stopped.is_set() else 'done', finished=time.time())
+        return self.progress()
+
+    def _warm(self, uid, scanfolder):
+        if self._stopped.is_set():
+            return
+        with self._lock:
+            self._progress['current'].append(uid)
+        cpu_start = time.thread_time()
+        outcome = 'done'
+        try:
+            scan = Scan.fromID(uid, scanfolder=scanfolder, read_volume=False)
+            scan.load_header()
+
+            volume = self.volumes.get(scan)
+            if volume is None and (self._cache_filled or self._cache_full(scan)):
+                # Warming more would evict the scans warmed first, which are the more recent ones
+                self._cache_filled = True
+                outcome = 'skipped'
+                return
+
+            if self.compress and not self._has_compressed_volume(scan):
+                # Written before the volume is cached, since the cache is keyed by the stored volumes of the
+                # scan. The cache is then filled from the volume read here
+                if volume is None:
+                    source_bytes = self._source_bytes(scan)
+                    self._pacer.pace(source_bytes)
+                    scan.volume = scan.read_slices()
+                    self._count(bytes_read=source_bytes)
+                else:
+                    scan.volume = volume
+                scan.store_compressed_volume()
+                volume = self.volumes.get(scan)
+
+            if volume is None:
+                source_bytes = 0 if len(scan.volume) else self._source_bytes(scan)
+                self._pacer.pace(source_bytes)
+                self.volumes.get_or_load(scan)
+                self._count(bytes_read=source_bytes)
+        except Exception:
+            logger.exception('uid %s: Error warming scan', uid)
+            outcome = 'failed'
+        finally:
+            with self._lock:
+                self._progress['current'].remove(uid)
+                self._progress[outcome] += 1
+            self._throttle_cpu(time.thread_time() - cpu_start)
+
+    def _cache_full(self, scan):
+        cached_bytes = sum(size for _, size, _ in self.volumes.entries())
+        shape = scan.stored_shape()
+        return cached_bytes + int(shape[0]) * int(shape[1]) * int(shape[2]) * scan.dtype.itemsize > \
+            self.volumes.max_bytes
+
+    @staticmethod
+    def _source_bytes(scan):
+        # The compressed volume is read when there is one, the .mat file otherwise
+        for path in (compressed_volume_path(scan.uid, scan.compressed_volume_directory),
+                     packed_volume_path(scan.uid, scan.compressed_volume_directory), scan.path):
+            if os.path.isfile(path):
+                return os.path.getsize(path)
+        return 0
+
+    @staticmethod
+    def _has_compressed_volume(scan):
+        return os.path.isfile(compressed_volume_path(scan.uid, scan.compressed_volume_directory)) or \
+            os.path.isfile(packed_volume_path(scan.uid, scan.compressed_volume_directory))
+
+    def _throttle_cpu(self, cpu_seconds):
+        if self.cpu_fraction and self.cpu_fraction < 1:
+            # Waiting stops early when warming is stopped
+            self._stopped.wait(cpu_seconds * (1.0 / self.cpu_fraction - 1))
+
+    def _count(self, **counts):
+        with self._lock:
+            for name, value in counts.items():
+                self._progress[name] += value
+
+    def _update(self, **values):
+        with self._lock:
+            self._progress.update(values)
+
+    def progress(self):
+        """ Snapshot of the progress: the state, the scans done, skipped and failed out of the total, the
+            scans being warmed, the bytes read and the elapsed seconds """
+        with self._lock:
+            progress = dict(self._progress, current=list(self._progress['current']))
+        if progress['started'] is not None:
+            progress['elapsed_s'] = (progress['finished'] or time.time()) - progress['started']
+        return progress
+
+    def stop(self):
+        """ Stops warming once the scans being warmed are done """
+        self._stopped.set()
+
+    def join(self, timeout=None):
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+
+def main(argv=None):
+    from app import create_app
+    from volume_cache import VolumeCache
+
+    parser = argparse.ArgumentParser(description='Warm the header index and volume caches of the worklist')
+    parser.add_argument('uids', nargs='*', help='uids of the scans to warm (default: the worklist of the app)')
+    parser.add_argument('--folder', default='', help='folder of the .mat scans (default: CTscans)')
+    parser.add_argument('--limit', type=int, help='number of most recent scans to warm')
+    parser.add_argument('--workers', type=int, help='scans warmed at the same time')
+    parser.add_argument('--read-mb-per-s', type=float, help='read budget over all workers')
+    parser.add_argument('--cpu-fraction', type=float, help='CPU budget of every worker, as a fraction of a CPU')
+    parser.add_argument('--compress', action='store_true', help='also write missing compressed volumes')
+    args = parser.parse_args(argv)
+
+    app = create_app({'WARMUP_ON_START': False})
+    config = app.config
+    warmer = Warmer(VolumeCache(config['VOLUME_CACHE_DIR'], config['VOLUME_CACHE_BYTES']),
+                    max_workers=args.workers or config['WARMUP_WORKERS'],
+                    read_mb_per_s=args.read_mb_per_s or config['WARMUP_READ_MB_PER_S'],
+                    cpu_fraction=args.cpu_fraction or config['WARMUP_CPU_FRACTION'],
+                    compress=args.compress or config['WARMUP_COMPRESS'])
+    warmer.start(app, args.folder, config['WORKLIST_UIDS'], args.limit or config['WARMUP_LIMIT'], args.uids or None)
+    try:
+        while warmer.running():
+            warmer.join(1.0)
+            progress = warmer.progress()
+            print('%-8s %d/%d scans, %d skipped, %d failed, %.1f MB read, %.0f s %s' %
+                  (progress['state'], progress['done'], progress['total'], progress['skipped'],
+                   progress['failed'], progress['bytes_read'] / 1e6, progress.get('elapsed_s', 0),
+                   ' '.join(progress['current'])))
+    except KeyboardInterrupt:
+        warmer.stop()
+        warmer.join()
+    return warmer.progress()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+import logging
+import storage
+from base import db
+from scan import Scan, uids
+
+logger = logging.getLogger(__name__)
+
+
+class ScanHeader(db.Model):
+    """ Worklist header of a single scan, keyed by the hash of its uid. The mtime and
+        file size of the .mat file are kept so only changed files are parsed again """
+    __tablename__ = 'scan_header'
+
+    hash = db.Column(db.String(16), primary_key=True)
+    uid = db.Column(db.String(128), nullable=False)
+    accession_number = db.Column(db.String(64), index=True)
+    patient_name = db.Column(db.String(128), index=True)
+    num_slices = db.Column(db.Integer)
+    body_part = db.Column(db.String(16))
+    plane = db.Column(db.String(16))
+    mtime = db.Column(db.Float, nullable=False, index=True)
+    file_size = db.Column(db.BigInteger, nullable=False)
+    valid = db.Column(db.Boolean, nullable=False, default=True, index=True)
+
+    def to_dict(self):
+        return {'accessionNumber': self.accession_number, 'patientName': self.patient_name, 'uid': self.uid}
+
+
+sort_columns = {'accessionNumber': ScanHeader.accession_number,
+                'patientName': ScanHeader.patient_name,
+                'uid': ScanHeader.uid,
+                'modified': ScanHeader.mtime}
+
+
+def update_index(scanfolder='', scan_uids=None):
+    """ Brings the header index in sync with the scan folder. Only scans whose .mat file
+        is new or has a different mtime/size are parsed. Without scan_uids, all scans found in the
+        folder are indexed. Returns the number of parsed scans """
+    if scan_uids is None:
+        scan_files = storage.default.list_scan_files(scanfolder or None, uids)
+    else:
+        scan_files = storage.default.list_scan_files(scanfolder or None, scan_uids, read_uids=False)
+
+    indexed = {header.hash: header for header in ScanHeader.query.all()}
+
+    parsed = 0
+    for hash, (uid, stat) in scan_files.items():
+        header = indexed.pop(hash, None)
+        if header is not None and header.mtime == stat.st_mtime and header.file_size == stat.st_size:
+            continue
+
+        if header is None:
+            header = ScanHeader(hash=hash)
+            db.session.add(header)
+
+        header.uid = uid
+        header.mtime = stat.st_mtime
+        header.file_size = stat.st_size
+        parsed += 1
+
+        try:
+            # Metadata, body part and plane are read on first access, and may fail just as well
+            scan = Scan.fromID(uid, scanfolder=scanfolder, read_volume=False)
+            header.accession_number = scan.metadata.get('AccessionNumber', '')
+            header.patient_name = scan.name
+            header.num_slices = int(scan.size[0])
+            header.body_part = scan.body_part
+            header.plane = scan.plane
+        except Exception:
+            # Keep the failed file in the index so it is only retried once it changes
+            logger.exception('uid %s: Error reading scan header', uid)
+            header.valid = False
+            continue
+
+        header.valid = True
+
+    # Whatever is left in the index no longer has a scan file
+    for header in indexed.values():
+        db.session.delete(header)
+
+    db.session.commit()
+    return parsed
+
+
+def query_worklist(page=1, per_page=50, sort='accessionNumber', order='asc'):
+    column = sort_columns.get(sort, ScanHeader.accession_number)
+    column = column.desc() if order == 'desc' else column.asc()
+
+    query = ScanHeader.query.filter_by(valid=True).order_by(column, ScanHeader.hash)
+    return query.paginate(page=page, per_page=per_page, error_out=False)
+